@@ -0,0 +1,405 @@
+#!/usr/bin/python
+##############################################################################
+#                                                                            #
+#  ncbench.py                                                                #
+#                                                                            #
+#  Objective:                                                                #
+#    Benchmarks for the ncproxy NETCONF proxy                                #
+#                                                                            #
+#  License:                                                                  #
+#    Licensed under the BSD license                                          #
+#    See LICENSE.md delivered with this project for more information.        #
+#                                                                            #
+##############################################################################
+
+"""
+Benchmarks for the ncproxy NETCONF proxy
+"""
+
+import argparse
+import logging
+import os
+import paramiko
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from ncproxy import ncFramer, nc_peek, nc_send, nc_size
+
+__title__ = "ncbench"
+__version__ = "1.0"
+
+
+# --- framing micro-benchmark ------------------------------------------------
+
+def legacy_deframe(buf, data):
+    """
+    Message extraction as done by ncproxy up to version 1.4, kept as the
+    reference for the framing benchmark.
+    """
+    buf += data
+    msgs = []
+    if len(buf) > 4:
+        if buf[0:2] != b"\n#":
+            msgs = buf.split(b"]]>]]>")
+            buf = msgs.pop()
+        else:
+            tmp = b""
+            pos = 0
+            while pos < len(buf) and len(buf) > 4:
+                if buf[pos:pos + 4] == b"\n##\n":
+                    msgs.append(tmp)
+                    tmp = b""
+                    buf = buf[pos + 4:]
+                    pos = 0
+                elif buf[pos:pos + 2] == b"\n#":
+                    idx = buf.find(b"\n", pos + 2)
+                    if idx != -1:
+                        size = int(buf[pos + 2:idx])
+                        tmp += buf[idx + 1:idx + 1 + size]
+                        pos = idx + 1 + size
+                    else:
+                        break
+                else:
+                    buf = b""
+                    break
+    return buf, msgs
+
+
+def framing_stream(size, chunksize, base10):
+    msg = b'<rpc-reply message-id="1"><data>' + b'x' * size + b'</data></rpc-reply>'
+    if base10:
+        return msg + b']]>]]>'
+    out = []
+    for pos in range(0, len(msg), chunksize):
+        out.append(b'\n#%d\n' % len(msg[pos:pos + chunksize]))
+        out.append(msg[pos:pos + chunksize])
+    out.append(b'\n##\n')
+    return b''.join(out)
+
+
+def bench_framing(options):
+    print('%-8s %-7s %12s %12s %12s' % ('framing', 'size', 'ncFramer', 'legacy', 'speedup'))
+    for base10 in (True, False):
+        for size in options.sizes:
+            stream = framing_stream(size, options.chunksize, base10)
+            pieces = [stream[pos:pos + options.recvsize] for pos in range(0, len(stream), options.recvsize)]
+
+            t0 = time.time()
+            framer = ncFramer()
+            count = 0
+            for piece in pieces:
+                framer.feed(piece)
+                for msg in framer:
+                    count += 1
+            t1 = time.time()
+            assert count == 1
+
+            if options.nolegacy:
+                t2 = t1
+            else:
+                buf, count = b'', 0
+                for piece in pieces:
+                    buf, msgs = legacy_deframe(buf, piece)
+                    count += len(msgs)
+                t2 = time.time()
+                assert count == 1
+
+            print('%-8s %-7s %10.1fms %10.1fms %11.1fx' % (
+                'base1.0' if base10 else 'base1.1', human(size),
+                (t1 - t0) * 1000, (t2 - t1) * 1000, (t2 - t1) / max(t1 - t0, 1e-9)))
+
+
+# --- end-to-end benchmark ---------------------------------------------------
+
+HELLO = (b'<?xml version="1.0" encoding="UTF-8"?>'
+         b'<hello xmlns="urn:ietf:params:xml:ns:netconf:base:1.0"><capabilities>'
+         b'<capability>urn:ietf:params:netconf:base:1.0</capability>%s'
+         b'</capabilities>%s</hello>')
+BASE11 = b'<capability>urn:ietf:params:netconf:base:1.1</capability>'
+OPERATIONS = {
+    'get': b'<get/>',
+    'copy-config': b'<copy-config><target><running/></target><source><startup/></source></copy-config>',
+}
+
+
+def nc_recv(channel, framer):
+    while True:
+        msg = framer.pop()
+        if msg is not None:
+            return msg
+        data = channel.recv(1048576)
+        if not data:
+            raise EOFError('channel closed')
+        framer.feed(data)
+
+
+class ncStubHandler(paramiko.SubsystemHandler):
+    """
+    NETCONF server stub: answers every rpc with an rpc-reply carrying
+    <data> of the configured size, and <ok/> to close-session.
+    """
+
+    def start_subsystem(self, name, transport, channel):
+        stub = self.get_server()
+        framer = ncFramer()
+        nc_send(channel, HELLO % (BASE11, b'<session-id>1</session-id>') + ncFramer.EOM)
+        try:
+            hello = nc_recv(channel, framer)
+            base10 = BASE11 not in hello
+            while True:
+                msgtype, msgid, operation = nc_peek(nc_recv(channel, framer))
+                attr = b' message-id="%s"' % msgid.encode('utf-8') if msgid is not None else b''
+                if operation == 'close-session':
+                    nc_send(channel, framer.frame(b'<rpc-reply%s><ok/></rpc-reply>' % attr, base10))
+                    break
+                nc_send(channel, framer.frame(b'<rpc-reply%s><data>%s</data></rpc-reply>' % (attr, stub.payload), base10))
+        except (EOFError, socket.error):
+            pass
+        transport.close()
+
+
+class ncStub(paramiko.ServerInterface):
+    """
+    NETCONF over SSH server stub listening on a free localhost port,
+    running in the benchmark process.
+    """
+
+    def __init__(self):
+        self.hostkey = paramiko.RSAKey.generate(2048)
+        self.payload = b''
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(100)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self.accept, name='ncStub')
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        while True:
+            client, addr = self.sock.accept()
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.hostkey)
+            transport.set_subsystem_handler('netconf', ncStubHandler)
+            transport.start_server(server=self)
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+
+def client_session(port, base11, rpcs, barrier, latencies, operation='get'):
+    """
+    Runs one NETCONF client session: after the hello exchange all sessions
+    start sending rpcs of operation at the same time, each waiting for the
+    reply before sending the next one.
+    """
+    transport = paramiko.Transport(('127.0.0.1', port))
+    try:
+        transport.connect(username='bench', password='bench')
+        channel = transport.open_session()
+        channel.invoke_subsystem('netconf')
+        framer = ncFramer()
+        hello = nc_recv(channel, framer)
+        nc_send(channel, HELLO % (BASE11 if base11 else b'', b'') + ncFramer.EOM)
+        base10 = not base11 or BASE11 not in hello
+
+        barrier.wait()
+        for idx in range(rpcs):
+            start = time.time()
+            nc_send(channel, framer.frame(b'<rpc message-id="%d" xmlns="urn:ietf:params:xml:ns:netconf:base:1.0">%s</rpc>' % (idx, OPERATIONS[operation]), base10))
+            nc_recv(channel, framer)
+            latencies.append(time.time() - start)
+        nc_send(channel, framer.frame(b'<rpc message-id="close" xmlns="urn:ietf:params:xml:ns:netconf:base:1.0"><close-session/></rpc>', base10))
+        nc_recv(channel, framer)
+    except Exception:
+        barrier.abort()
+        raise
+    finally:
+        transport.close()
+
+
+def load(port, sessions, base11, rpcs, operation='get'):
+    """
+    Returns the latencies of all rpcs and the time from the start of the
+    first to the reply of the last rpc.
+    """
+    barrier = threading.Barrier(sessions + 1)
+    latencies = []
+    threads = [threading.Thread(target=client_session, args=(port, base11, rpcs, barrier, latencies, operation))
+               for idx in range(sessions)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    barrier.wait()
+    start = time.time()
+    for thread in threads:
+        thread.join()
+    if len(latencies) != sessions * rpcs:
+        raise RuntimeError('%d of %d rpcs answered' % (len(latencies), sessions * rpcs))
+    return sorted(latencies), time.time() - start
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def proc_usage(pid):
+    """
+    Returns CPU seconds and peak RSS bytes of process pid (Linux only).
+    """
+    with open('/proc/%d/stat' % pid) as file:
+        fields = file.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+    rss = 0
+    with open('/proc/%d/status' % pid) as file:
+        for line in file:
+            if line.startswith('VmHWM:'):
+                rss = int(line.split()[1]) * 1024
+    return cpu, rss
+
+
+class ncProxyProcess(object):
+    """
+    ncproxy started as a separate process in front of the stub.
+    """
+
+    def __init__(self, stubport, hostkey, patch=None, args=()):
+        self.port = free_port()
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ncproxy.py'),
+                   '--port', str(self.port), '--proxyhostkey', hostkey,
+                   '--serverlog', os.devnull, '--clientlog', os.devnull]
+        if patch is not None:
+            command += ['--patch', patch]
+        command += list(args) + ['127.0.0.1:%d' % stubport]
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        deadline = time.time() + 30
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError('ncproxy exited with %d' % self.process.returncode)
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                break
+            except socket.error:
+                if time.time() > deadline:
+                    self.stop()
+                    raise RuntimeError('ncproxy not listening')
+                time.sleep(0.1)
+
+    def usage(self):
+        return proc_usage(self.process.pid)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def bench_e2e(options):
+    """
+    Measures rpc rate, latency and ncproxy CPU time and peak RSS for each
+    combination of framing, reply size, session count, rule set and rpc
+    operation. A new ncproxy process is started per measurement. Client
+    sessions and the stub run in this process, so direct and proxy runs
+    share their cost.
+    """
+    logging.getLogger('paramiko').addHandler(logging.NullHandler())
+    logging.getLogger('paramiko').propagate = False
+    stub = ncStub()
+    keyfile = tempfile.NamedTemporaryFile(prefix='ncbench-', suffix='.key', delete=False)
+    keyfile.close()
+    paramiko.RSAKey.generate(2048).write_private_key_file(keyfile.name)
+
+    print('%-6s %-8s %-7s %8s %-12s %-11s %7s %10s %9s %9s %9s %9s' % (
+        'mode', 'framing', 'size', 'sessions', 'patch', 'operation', 'rpcs', 'rpc/s', 'p50', 'p99', 'cpu', 'rss'))
+    try:
+        for framing in options.framing:
+            for size in options.sizes:
+                stub.payload = b'x' * size
+                for sessions in options.sessions:
+                    for patch in options.patch:
+                        for operation in options.operations:
+                            for mode in options.modes:
+                                if mode == 'direct' and patch != 'none':
+                                    continue
+                                proxy = None
+                                port = stub.port
+                                if mode == 'proxy':
+                                    proxy = ncProxyProcess(stub.port, keyfile.name, None if patch == 'none' else patch,
+                                                           shlex.split(options.proxyargs))
+                                    port = proxy.port
+                                try:
+                                    cpu0 = proxy and proxy.usage()[0]
+                                    latencies, elapsed = load(port, sessions, framing == 'base1.1', options.rpcs, operation)
+                                    cpu = rss = '-'
+                                    if proxy is not None:
+                                        cpu1, rss = proxy.usage()
+                                        cpu = '%.2fs' % (cpu1 - cpu0)
+                                        rss = human(rss)
+                                finally:
+                                    if proxy is not None:
+                                        proxy.stop()
+
+                                print('%-6s %-8s %-7s %8d %-12s %-11s %7d %10.1f %7.2fms %7.2fms %9s %9s' % (
+                                    mode, framing, human(size), sessions, os.path.basename(patch), operation, len(latencies),
+                                    len(latencies) / elapsed, latencies[len(latencies) // 2] * 1000,
+                                    latencies[int(len(latencies) * 0.99)] * 1000, cpu, rss))
+                                sys.stdout.flush()
+    finally:
+        os.unlink(keyfile.name)
+
+
+# --- helpers ----------------------------------------------------------------
+
+def human(size):
+    for unit in ('', 'K', 'M', 'G'):
+        if size < 1024:
+            return '%d%s' % (size, unit)
+        size //= 1024
+    return '%dT' % size
+
+
+if __name__ == '__main__':
+    prog = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--version', action='version', version=prog + ' ' + __version__)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    cmd = commands.add_parser('framing', help='NETCONF framing micro-benchmark')
+    cmd.add_argument('--sizes', metavar='size', type=nc_size, nargs='+', default=[1024, 1024 * 1024, 8 * 1024 * 1024], help='message sizes (default: <1K 1M 8M>)')
+    cmd.add_argument('--chunksize', metavar='bytes', type=int, default=4096, help='base:1.1 chunk size (default: <4096>)')
+    cmd.add_argument('--recvsize', metavar='bytes', type=int, default=32768, help='bytes per channel read (default: <32768>)')
+    cmd.add_argument('--nolegacy', action='store_true', help='skip the legacy framing code')
+    cmd.set_defaults(func=bench_framing)
+
+    cmd = commands.add_parser('e2e', help='end-to-end benchmark: proxy vs direct connection to a local NETCONF stub')
+    cmd.add_argument('--modes', choices=['direct', 'proxy'], nargs='+', default=['direct', 'proxy'], help='connect through ncproxy or directly (default: <direct proxy>)')
+    cmd.add_argument('--framing', choices=['base1.0', 'base1.1'], nargs='+', default=['base1.0', 'base1.1'], help='NETCONF framing (default: <base1.0 base1.1>)')
+    cmd.add_argument('--sizes', metavar='size', type=nc_size, nargs='+', default=[1024, 1024 * 1024], help='rpc-reply sizes (default: <1K 1M>)')
+    cmd.add_argument('--sessions', metavar='count', type=int, nargs='+', default=[1, 8], help='concurrent client sessions (default: <1 8>)')
+    cmd.add_argument('--patch', metavar='filename', nargs='+', default=['none'], help='ncproxy rule sets, none for no rules (default: <none>)')
+    cmd.add_argument('--operations', choices=sorted(OPERATIONS), nargs='+', default=['get'], help='rpc operations sent by the clients (default: <get>)')
+    cmd.add_argument('--rpcs', metavar='count', type=int, default=50, help='rpcs per session (default: <50>)')
+    cmd.add_argument('--proxyargs', metavar='args', default='', help='additional ncproxy options (default: <none>)')
+    cmd.set_defaults(func=bench_e2e)
+
+    options = parser.parse_args()
+    options.func(options)
+
+# EOF
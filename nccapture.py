@@ -0,0 +1,143 @@
+#!/usr/bin/python
+##############################################################################
+#                                                                            #
+#  nccapture.py                                                              #
+#                                                                            #
+#  Objective:                                                                #
+#    Query and export tool for indexed ncproxy capture files                 #
+#                                                                            #
+#  License:                                                                  #
+#    Licensed under the BSD license                                          #
+#    See LICENSE.md delivered with this project for more information.        #
+#                                                                            #
+##############################################################################
+
+"""
+Query and export tool for indexed ncproxy capture files
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from ncproxy import ncCaptureReader, nc_reindex
+
+__title__ = "nccapture"
+__version__ = "1.0"
+
+
+def timearg(value):
+    """
+    Accepts seconds since the epoch or local time as 'YYYY-MM-DD HH:MM:SS'
+    (the 'T' separator and omitting seconds or time are allowed).
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('invalid time: %s' % value)
+
+
+def timestr(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)) + ('%.3f' % (timestamp % 1))[1:]
+
+
+def records(options):
+    for filename in options.files:
+        reader = ncCaptureReader(filename)
+        try:
+            for record in reader.select(options.session, options.since, options.until, options.messageid, options.direction):
+                if options.operation is not None and record.operation != options.operation:
+                    continue
+                yield record
+        finally:
+            reader.close()
+
+
+def cmd_list(options):
+    print('%-40s %8s %9s  %-23s  %-23s' % ('file', 'session', 'messages', 'first', 'last'))
+    for filename in options.files:
+        reader = ncCaptureReader(filename)
+        sessions = {}
+        for idx in range(reader.count):
+            timestamp, session = reader.entry(idx)[1:3]
+            if session not in sessions:
+                sessions[session] = [0, timestamp, timestamp]
+            sessions[session][0] += 1
+            sessions[session][2] = timestamp
+        for session in sorted(sessions):
+            count, first, last = sessions[session]
+            print('%-40s %8d %9d  %-23s  %-23s' % (os.path.basename(filename), session, count, timestr(first), timestr(last)))
+        reader.close()
+
+
+def cmd_query(options):
+    print('%-23s %8s %-6s %-12s %-10s %-20s %10s' % ('time', 'session', 'dir', 'type', 'message-id', 'operation', 'bytes'))
+    for record in records(options):
+        print('%-23s %8d %-6s %-12s %-10s %-20s %10d' % (
+            timestr(record.timestamp), record.session, record.direction, record.msgtype or '-',
+            record.msgid or '-', record.operation or '-', len(record.data)))
+
+
+def cmd_export(options):
+    """
+    Writes the selected messages in the framed text form of --serverlog
+    and --clientlog.
+    """
+    out = options.output or getattr(sys.stdout, 'buffer', sys.stdout)
+    for record in records(options):
+        out.write(record.data)
+    out.flush()
+
+
+def cmd_reindex(options):
+    for filename in options.files:
+        nc_reindex(filename)
+
+
+if __name__ == '__main__':
+    prog = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--version', action='version', version=prog + ' ' + __version__)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    select = argparse.ArgumentParser(add_help=False)
+    select.add_argument('--session', metavar='id', type=int, help='messages of session id')
+    select.add_argument('--since', metavar='time', type=timearg, help='messages captured at or after time')
+    select.add_argument('--until', metavar='time', type=timearg, help='messages captured before time')
+    select.add_argument('--messageid', metavar='id', help='rpc and rpc-reply with message-id')
+    select.add_argument('--operation', metavar='name', help='rpc and rpc-reply of operation (e.g. get-config)')
+    select.add_argument('--direction', choices=['client', 'server'], help='messages sent by client or server')
+
+    cmd = commands.add_parser('list', help='list sessions')
+    cmd.set_defaults(func=cmd_list)
+
+    cmd = commands.add_parser('query', parents=[select], help='list selected messages')
+    cmd.set_defaults(func=cmd_query)
+
+    cmd = commands.add_parser('export', parents=[select], help='export selected messages as text capture')
+    cmd.add_argument('-o', '--output', metavar='filename', type=argparse.FileType('wb'), help='output file (default: <stdout>)')
+    cmd.set_defaults(func=cmd_export)
+
+    cmd = commands.add_parser('reindex', help='rebuild the index of capture files')
+    cmd.set_defaults(func=cmd_reindex)
+
+    for cmd in commands.choices.values():
+        cmd.add_argument('files', metavar='file.ncap', nargs='+', help='capture files')
+
+    options = parser.parse_args()
+    try:
+        options.func(options)
+    except (IOError, ValueError) as e:
+        sys.stderr.write('%s: %s\n' % (prog, str(e)))
+        sys.exit(1)
+
+# EOF
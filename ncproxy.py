@@ -37,22 +37,56 @@ Copyright (C) 2018 MT2. All Rights Reserved
 """
 
 import binascii
+import bisect
+import collections
+import errno
+import gzip
+import hashlib
+import hmac
+import itertools
 import logging
+import mmap
+import multiprocessing
 import os
 import paramiko
+import selectors
 import socket
+import struct
 import sys
+import tempfile
 import threading
 import time
 import traceback
 import argparse
 import json
 import re
+import signal
+import zlib
 
 if sys.version_info > (3,):
     from urllib.parse import urlparse
+    from http.server import BaseHTTPRequestHandler, HTTPServer
 else:
     from urlparse import urlparse
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT, getattr(sre_constants, 'POSSESSIVE_REPEAT', None))
 
 __title__ = "ncproxy"
 __version__ = "1.4"
@@ -61,210 +95,3563 @@ __author__ = "Stephane Bryant"
 __date__ = "2018 July 10"
 
 
+class ncFramingError(Exception):
+    pass
+
+
+class ncFramer(object):
+    """
+    Incremental NETCONF framing codec (RFC 6242) for one direction.
+
+    Received bytes are appended by feed(), complete messages are taken out
+    by pop() or by iterating over the framer. The framing method is detected
+    at every message boundary, so end-of-message framing (base:1.0) for the
+    <hello> exchange followed by chunked framing (base:1.1) is handled without
+    further configuration. Received bytes are moved into the message being
+    parsed as they are looked at and are never rescanned; chunk headers and
+    delimiters are kept with them, so the message can be forwarded as
+    received. A message growing beyond maxbuffer bytes is spooled to a
+    temporary file and returned as a read-only mmap instead of bytes, so its
+    size is not limited by memory.
+
+    With headsize set only the message boundaries are tracked: pop() returns
+    the first headsize bytes of each message, the rest of the message is
+    discarded as it is looked at and framed() is not available. The head is
+    enough for nc_peek(), so passthrough sessions can be accounted without
+    copying every message.
+
+    With a stream callback set, it is called with the first peeksize bytes
+    of every message longer than that. If it returns True, the rest of the
+    message is not kept but handed out by flush() as received, framing
+    included, so it can be forwarded before the message is complete; pop()
+    returns the head of such a message and framed() returns None for it.
+    """
+
+    EOM = b']]>]]>'
+    EOC = b'\n##\n'
+    MAXCHUNK = 4294967295
+    SPOOLHEAD = mmap.ALLOCATIONGRANULARITY
+
+    def __init__(self, maxbuffer=None, headsize=None, stream=None, peeksize=4096):
+        self.maxbuffer = maxbuffer
+        self.headsize = headsize
+        self.stream = stream
+        self.peeksize = peeksize
+        self.spool = None
+        self.reset()
+        self.base10 = True
+
+    def reset(self):
+        if self.spool is not None:
+            self.spool.close()
+        self.buf = bytearray()  # received bytes not looked at
+        self.inmsg = None       # framing of the message being parsed
+        self.raw = bytearray()  # message being parsed, framing included
+        self.spans = []         # [start, end] of the message parts in raw
+        self.spool = None       # temporary file holding it above maxbuffer
+        self.streaming = None   # message is streamed, None if undecided
+        self.out = bytearray()  # streamed bytes not flushed
+        self.size = 0
+        self.remaining = 0      # bytes missing of the current chunk
+        self.last = None        # (msg, framed) of the last pop()
+
+    def feed(self, data):
+        self.buf += data
+
+    def store(self, size):
+        """
+        Moves size bytes from the receive buffer into the message.
+        """
+        if self.streaming is None and self.stream is not None and self.headsize is None \
+                and self.spool is None and self.size + size >= self.peeksize:
+            head = self.peeksize - self.size
+            self.append(head)
+            self.decide()
+            size -= head
+        self.append(size)
+
+    def decide(self):
+        """
+        Asks the stream callback whether to stream the message being parsed;
+        if so, the bytes received so far are moved to the stream output and
+        only the head is kept.
+        """
+        with memoryview(self.raw) as view:
+            head = b''.join(view[start:end] for start, end in self.spans)
+        self.streaming = bool(self.stream(head))
+        if self.streaming:
+            self.out += self.raw
+            self.raw = bytearray(head)
+            self.spans = []
+
+    def append(self, size):
+        if not size:
+            return
+        if self.streaming:
+            self.out += self.buf[:size]
+            del self.buf[:size]
+            self.size += size
+            return
+        if self.headsize is not None:
+            keep = max(0, min(size, self.headsize - len(self.raw)))
+            if keep:
+                self.raw += self.buf[:keep]
+            del self.buf[:size]
+            self.size += size
+            return
+        if self.spool is None and self.maxbuffer is not None and self.size + size > self.maxbuffer:
+            self.spool = tempfile.TemporaryFile(prefix='ncproxy-')
+            self.spool.seek(self.SPOOLHEAD)
+            with memoryview(self.raw) as view:
+                for start, end in self.spans:
+                    self.spool.write(view[start:end])
+            self.raw = bytearray()
+        with memoryview(self.buf) as view:
+            if self.spool is None:
+                self.raw += view[:size]
+                self.spans[-1][1] += size
+            else:
+                self.spool.write(view[:size])
+        del self.buf[:size]
+        self.size += size
+
+    def keep(self, size):
+        """
+        Moves size bytes of framing from the receive buffer into the message.
+        """
+        if self.streaming:
+            self.out += self.buf[:size]
+        elif self.spool is None and self.headsize is None:
+            self.raw += self.buf[:size]
+        del self.buf[:size]
+
+    def framed(self):
+        """
+        Returns the framed bytes (including chunk headers and delimiters) of
+        the message returned by the last pop() call, as received, as a
+        memoryview. Spooled messages are returned in a single chunk.
+        """
+        return self.last[1]
+
+    def flush(self):
+        """
+        Returns the bytes of the streamed message received since the last
+        call, framing included.
+        """
+        out, self.out = self.out, bytearray()
+        return out
+
+    def pending(self):
+        return len(self.buf) + self.size
+
+    def pop(self):
+        """
+        Returns the next complete message without framing, or None if more
+        bytes are needed. Raises ncFramingError on invalid chunked framing;
+        the framer is reset in that case.
+        """
+        buf = self.buf
+
+        if self.inmsg is None:
+            if len(buf) < 2:
+                return None
+            self.inmsg = buf[0:2] != b'\n#'
+            if self.inmsg:
+                self.spans = [[0, 0]]
+
+        if self.inmsg:
+            # --- base:1.0 framing (EOM) -------------------------------------
+            idx = buf.find(self.EOM)
+            if idx == -1:
+                self.store(max(0, len(buf) - len(self.EOM) + 1))
+                return None
+            self.store(idx)
+            self.keep(len(self.EOM))
+
+        else:
+            # --- base:1.1 framing (chunks) ----------------------------------
+            while True:
+                if self.remaining:
+                    size = min(self.remaining, len(buf))
+                    self.store(size)
+                    self.remaining -= size
+                    if self.remaining:
+                        return None
+                if len(buf) < 4:
+                    return None
+                if buf[0:4] == self.EOC:
+                    self.keep(4)
+                    break
+                if buf[0:2] != b'\n#':
+                    self.reset()
+                    raise ncFramingError('chunk header expected')
+                idx = buf.find(b'\n', 2, 13)
+                if idx == -1:
+                    if len(buf) >= 13:
+                        self.reset()
+                        raise ncFramingError('chunk size too long')
+                    return None
+                size = buf[2:idx]
+                if not size.isdigit() or size[0:1] == b'0' or int(size) > self.MAXCHUNK:
+                    self.reset()
+                    raise ncFramingError('invalid chunk size')
+                self.remaining = int(size)
+                self.keep(idx + 1)
+                self.spans.append([len(self.raw), len(self.raw)])
+
+        if self.spool is not None:
+            msg, framed = self.unspool()
+        elif self.headsize is not None or self.streaming:
+            msg, framed = bytes(self.raw), None
+        else:
+            framed = memoryview(self.raw)
+            msg = b''.join(framed[start:end] for start, end in self.spans)
+        self.base10 = self.inmsg
+        self.last = (msg, framed)
+        self.inmsg = None
+        self.streaming = None
+        self.raw = bytearray()
+        self.spans = []
+        self.size = 0
+        return msg
+
+    def unspool(self):
+        """
+        Completes the spooled message: the file is given chunk header and
+        delimiter around the message and mapped into memory twice, as the
+        message and as the framed message. The file is unlinked already and
+        disappears together with the last reference to the mappings.
+        """
+        spool = self.spool
+        self.spool = None
+        header = b'' if self.inmsg else b'\n#%d\n' % self.size
+        trailer = self.EOM if self.inmsg else self.EOC
+        spool.write(trailer)
+        spool.seek(self.SPOOLHEAD - len(header))
+        spool.write(header)
+        spool.flush()
+        try:
+            msg = mmap.mmap(spool.fileno(), self.size, offset=self.SPOOLHEAD, access=mmap.ACCESS_READ)
+            whole = mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            spool.close()
+        framed = memoryview(whole)[self.SPOOLHEAD - len(header):self.SPOOLHEAD + self.size + len(trailer)]
+        return msg, framed
+
+    def idle(self):
+        """
+        Returns True at a message boundary, with no bytes of the next
+        message received.
+        """
+        return self.inmsg is None and not self.buf
+
+    def __iter__(self):
+        while True:
+            msg = self.pop()
+            if msg is None:
+                return
+            yield msg
+
+    def frame(self, msg, base10=None):
+        """
+        Returns msg framed for sending. Unless requested otherwise the framing
+        of the last message received is used.
+        """
+        if base10 is None:
+            base10 = self.base10
+        if base10:
+            return msg + self.EOM
+        return b''.join((b'\n#%d\n' % len(msg), msg, self.EOC))
+
+
+def nc_send(channel, data):
+    """
+    Sends all of data; unlike Channel.sendall() large buffers are not copied
+    for every partial send.
+    """
+    data = memoryview(data)
+    while data:
+        sent = channel.send(data)
+        if sent == 0:
+            raise socket.error('Channel closed')
+        data = data[sent:]
+
+
+def nc_size(value):
+    """
+    Converts a size argument with optional K, M or G suffix into bytes.
+    """
+    units = {'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+    value = value.upper().rstrip('B')
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+PEEK = re.compile(
+    rb'(?:\s|<\?.*?\?>|<!--.*?-->)*'
+    rb'<(?:[\w.-]+:)?([\w.-]+)((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>'
+    rb'(?:\s|<!--.*?-->)*'
+    rb'(?:<(?:[\w.-]+:)?([\w.-]+))?', re.DOTALL)
+MESSAGEID = re.compile(rb'\smessage-id\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+
+def nc_peek(msg, size=4096):
+    """
+    Returns the root element name, message-id and name of the first child
+    element of msg, looking only at the first bytes of the message. Names
+    are returned without namespace prefix, None if not found.
+    """
+    match = PEEK.match(msg[:size])
+    if match is None:
+        return None, None, None
+    root, attrs, child = match.groups()
+    msgid = MESSAGEID.search(attrs)
+    if msgid is not None:
+        msgid = (msgid.group(1) or msgid.group(2) or b'').decode('utf-8', 'replace')
+    if attrs.endswith(b'/'):
+        child = None
+    return root.decode('utf-8', 'replace'), msgid, child and child.decode('utf-8', 'replace')
+
+
+XMLDECL = re.compile(rb'^\s*<\?xml.*?\?>', re.DOTALL)
+INTERTAG = re.compile(rb'>\s+<')
+WHITESPACE = re.compile(rb'\s+')
+
+
+def nc_normalize(msg):
+    """
+    Returns msg without XML declaration and message-id, with whitespace
+    between elements removed and other whitespace collapsed, so that equal
+    requests compare equal.
+    """
+    msg = XMLDECL.sub(b'', msg, 1)
+    msg = MESSAGEID.sub(b'', msg, 1)
+    msg = INTERTAG.sub(b'><', msg)
+    return WHITESPACE.sub(b' ', msg.strip())
+
+
+def nc_messageid(msg, msgid):
+    """
+    Returns msg with the message-id of the root element set to msgid.
+    """
+    if msgid is None:
+        return msg
+    value = msgid.encode('utf-8').replace(b'&', b'&amp;').replace(b'"', b'&quot;')
+    return MESSAGEID.sub(lambda match: b' message-id="' + value + b'"', msg, 1)
+
+
+def nc_loadkey(filename, alg='RSA'):
+    """
+    Loads a private key file of algorithm 'RSA' or 'ECDSA'.
+    """
+    if alg == "ECDSA":
+        return paramiko.ECDSAKey.from_private_key_file(filename)
+    return paramiko.RSAKey.from_private_key_file(filename)
+
+
+def nc_hostkey(directory, alg='RSA'):
+    """
+    Returns the proxy host key of algorithm alg stored in directory. The key
+    is generated and stored on first use, so clients see the same host key
+    after restarts.
+    """
+    filename = os.path.join(directory, 'ssh_host_%s_key' % alg.lower())
+    if not os.path.exists(filename):
+        log.info('Generating new host key %s', filename)
+        if alg == 'ECDSA':
+            key = paramiko.ECDSAKey.generate()
+        else:
+            key = paramiko.RSAKey.generate(2048)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        # --- instances started at the same time must end up with one key ---
+        tmpname = '%s.%d' % (filename, os.getpid())
+        key.write_private_key_file(tmpname)
+        try:
+            os.link(tmpname, filename)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        finally:
+            os.unlink(tmpname)
+    return nc_loadkey(filename, alg)
+
+
+class ncRuleSet(object):
+    """
+    Compiled set of server-msg-modifier, client-msg-modifier and auto-respond
+    rules.
+
+    Rules are compiled once at load time. For every rule the literal strings
+    any match must contain are extracted from the regex; a rule is only run
+    if all its literals are found in the message. Literals shared by several
+    rules are searched once per message. Per rule the number of runs,
+    matches, prefilter skips and the time spent are recorded.
+
+    Rules may be restricted to messages by 'message-type' (name of the root
+    element, e.g. rpc, rpc-reply) and 'operation' (name of its first child,
+    e.g. copy-config, rpc-error), each a name or a list of names. The rules
+    selected for a message are looked up by the names nc_peek() finds at
+    the beginning of the message, so other rules never look at its body.
+
+    A rule set is not changed after it is compiled; new rules are loaded
+    into a new rule set with a higher version (see ncRules).
+    """
+
+    KINDS = ('server-msg-modifier', 'client-msg-modifier', 'auto-respond')
+    MINLITERAL = 3
+
+    def __init__(self, rules=None, literals=None):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.rules = {}
+        for kind in self.KINDS:
+            self.rules[kind] = tuple(self.compile(kind, idx, rule, literals and literals[kind][idx])
+                                     for idx, rule in enumerate((rules or {}).get(kind, [])))
+        self.selectors = dict((kind, self.index(self.rules[kind])) for kind in self.KINDS)
+
+    @classmethod
+    def load(cls, filename, cachedir=None):
+        """
+        Loads rules from a JSON or YAML (.yaml, .yml) file. With cachedir the
+        parsed rules, with patch-file and response-file contents resolved
+        and the prefilter literals extracted, are cached keyed by the
+        content hash and path of the rules file and the working directory
+        relative patch-file and response-file paths are resolved against. A
+        cache entry is used as long as the resolved files are unchanged.
+        """
+        with open(filename, 'rb') as file:
+            data = file.read()
+        cachefile = None
+        if cachedir is not None:
+            digest = hashlib.sha256(data)
+            for path in (os.path.abspath(filename), os.getcwd()):
+                digest.update(b'\0' + path.encode('utf-8', 'surrogateescape'))
+            cachefile = os.path.join(cachedir, 'rules-%s.json' % digest.hexdigest())
+            entry = cls.cached(cachefile)
+            if entry is not None:
+                log.debug('Rules %s loaded from cache', filename)
+                literals = dict((kind, [[literal.encode('latin-1') for literal in literals] for literals in rules])
+                                for kind, rules in entry['literals'].items())
+                return cls(entry['rules'], literals)
+
+        if os.path.splitext(filename)[1].lower() in ('.yaml', '.yml'):
+            if yaml is None:
+                raise ValueError('YAML rules require the PyYAML module')
+            rules = yaml.safe_load(data.decode('utf-8')) or {}
+        else:
+            rules = json.loads(data.decode('utf-8'))
+
+        # --- resolve patch-file/response-file -------------------------------
+        files = {}
+        for kind in cls.KINDS:
+            for rule in rules.get(kind) or []:
+                for action in ('patch', 'response'):
+                    if action + '-file' in rule:
+                        path = os.path.abspath(rule.pop(action + '-file'))
+                        with open(path, 'r') as file:
+                            rule[action] = file.read()
+                        stat = os.stat(path)
+                        files[path] = [stat.st_size, stat.st_mtime]
+            rules[kind] = rules.get(kind) or []
+        ruleset = cls(rules)
+
+        if cachefile is not None:
+            literals = dict((kind, [[literal.decode('latin-1') for literal in rule['literals']] for rule in ruleset[kind]])
+                            for kind in cls.KINDS)
+            try:
+                if not os.path.isdir(cachedir):
+                    os.makedirs(cachedir, 0o700)
+                with open(cachefile + '.%d' % os.getpid(), 'w') as file:
+                    json.dump({'files': files, 'rules': rules, 'literals': literals}, file)
+                os.rename(cachefile + '.%d' % os.getpid(), cachefile)
+            except (IOError, OSError) as e:
+                log.warning('Caching rules in %s failed: %s', cachedir, str(e))
+        return ruleset
+
+    @staticmethod
+    def cached(cachefile):
+        try:
+            with open(cachefile, 'r') as file:
+                entry = json.load(file)
+            for path, (size, mtime) in entry['files'].items():
+                stat = os.stat(path)
+                if [stat.st_size, stat.st_mtime] != [size, mtime]:
+                    return None
+            return entry
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def __getitem__(self, kind):
+        return self.rules[kind]
+
+    def compile(self, kind, idx, rule, literals=None):
+        rule = dict(rule)
+        if kind == 'auto-respond':
+            action = 'response'
+        else:
+            action = 'patch'
+        if action + '-file' in rule:
+            with open(rule[action + '-file'], 'r') as file:
+                rule[action] = file.read()
+        rule['action'] = rule[action].encode('utf-8')
+        rule['regex'] = re.compile(rule['match'].encode('utf-8'), re.DOTALL)
+        rule['literals'] = nc_literals(rule['regex']) if literals is None else literals
+        for key, names in (('message-type', 'msgtypes'), ('operation', 'operations')):
+            value = rule.get(key)
+            if value is not None and not isinstance(value, (list, tuple)):
+                value = [value]
+            rule[names] = frozenset(value) if value else None
+        rule['name'] = '%s[%d]' % (kind, idx)
+        rule['runs'] = 0
+        rule['matches'] = 0
+        rule['skipped'] = 0
+        rule['seconds'] = 0.0
+        log.debug('rule %s: prefilter %s', rule['name'], rule['literals'])
+        if rule['msgtypes'] or rule['operations']:
+            log.debug('rule %s: message-type %s operation %s', rule['name'],
+                      sorted(rule['msgtypes'] or ['*']), sorted(rule['operations'] or ['*']))
+        return rule
+
+    @staticmethod
+    def index(rules):
+        """
+        Returns a dict mapping (message type, operation) to the rules which
+        apply to such messages, in their original order, or None if no rule
+        has a selector. Names no rule selects are mapped to None.
+        """
+        msgtypes, operations = set([None]), set([None])
+        for rule in rules:
+            msgtypes.update(rule['msgtypes'] or ())
+            operations.update(rule['operations'] or ())
+        if len(msgtypes) == 1 and len(operations) == 1:
+            return None
+        index = {}
+        for msgtype in msgtypes:
+            for operation in operations:
+                index[msgtype, operation] = tuple(
+                    rule for rule in rules
+                    if (rule['msgtypes'] is None or msgtype in rule['msgtypes'])
+                    and (rule['operations'] is None or operation in rule['operations']))
+        return index
+
+    def select(self, kind, msg):
+        """
+        Returns the rules of kind which apply to msg.
+        """
+        index = self.selectors[kind]
+        if index is None:
+            return self.rules[kind]
+        msgtype, msgid, operation = nc_peek(msg)
+        if (msgtype, None) not in index:
+            msgtype = None
+        if (None, operation) not in index:
+            operation = None
+        return index[msgtype, operation]
+
+    def prefilter(self, rule, msg, found):
+        """
+        Returns False if msg does not contain all literals of rule. Results
+        are memorized in found, which must be cleared if msg changes.
+        """
+        for literal in rule['literals']:
+            if literal not in found:
+                found[literal] = msg.find(literal) != -1
+            if not found[literal]:
+                return False
+        return True
+
+    def account(self, rule, matched, seconds):
+        with self.lock:
+            rule['runs'] += 1
+            rule['matches'] += matched
+            rule['seconds'] += seconds
+
+    def skip(self, rule):
+        with self.lock:
+            rule['skipped'] += 1
+
+    def patch(self, kind, msg):
+        """
+        Applies the modifier rules of kind to msg. Returns the resulting
+        message and the number of substitutions made.
+        """
+        patched = 0
+        found = {}
+        for rule in self.select(kind, msg):
+            if not self.prefilter(rule, msg, found):
+                self.skip(rule)
+                continue
+            t0 = time.perf_counter()
+            if not isinstance(msg, bytes) and rule['regex'].search(msg) is None:
+                # --- subn() would copy a spooled message even without match
+                count = 0
+            else:
+                msg, count = rule['regex'].subn(rule['action'], msg)
+            self.account(rule, count > 0, time.perf_counter() - t0)
+            if count:
+                patched += count
+                found = {}
+        return msg, patched
+
+    def respond(self, msg):
+        """
+        Returns the auto-response for client message msg, or None if no
+        auto-respond rule matches.
+        """
+        found = {}
+        for rule in self.select('auto-respond', msg):
+            if not self.prefilter(rule, msg, found):
+                self.skip(rule)
+                continue
+            t0 = time.perf_counter()
+            if rule['regex'].match(msg):
+                response = rule['regex'].sub(rule['action'], msg)
+                self.account(rule, True, time.perf_counter() - t0)
+                return response
+            self.account(rule, False, time.perf_counter() - t0)
+        return None
+
+    def report(self):
+        with self.lock:
+            for kind in self.KINDS:
+                for rule in self.rules[kind]:
+                    log.info('rule v%d %s: runs=%d matches=%d skipped=%d time=%.3fs match=%s',
+                             self.version, rule['name'], rule['runs'], rule['matches'], rule['skipped'], rule['seconds'], rule['match'][:60])
+
+
+def nc_literals(regex):
+    """
+    Returns the literal byte strings (of MINLITERAL bytes or longer) every
+    match of the compiled regex must contain.
+    """
+    if regex.flags & re.IGNORECASE:
+        return []
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:
+        return []
+
+    literals = []
+
+    def required(items):
+        run = bytearray()
+        for op, av in items:
+            if op is sre_constants.LITERAL:
+                run.append(av)
+                continue
+            if op is sre_constants.AT:
+                continue
+            if len(run) >= ncRuleSet.MINLITERAL:
+                literals.append(bytes(run))
+            run = bytearray()
+            if op is sre_constants.SUBPATTERN:
+                if not av[1] & sre_constants.SRE_FLAG_IGNORECASE:
+                    required(av[-1])
+            elif op in REPEATS and av[0] >= 1:
+                required(av[2])
+        if len(run) >= ncRuleSet.MINLITERAL:
+            literals.append(bytes(run))
+
+    required(parsed)
+    return sorted(set(literals), key=len, reverse=True)
+
+
+class ncRules(object):
+    """
+    Current version of the patch rules loaded from filename.
+
+    The rules file is reloaded when modified or on reload(). Every load
+    compiles a new ncRuleSet with the next version number, which replaces
+    the current one by a single reference assignment; sessions keep using
+    the rule set they hold until they pick up the new one at a message
+    boundary. Rules failing to load are rejected and the current version
+    is kept.
+    """
+
+    def __init__(self, filename=None, cachedir=None, interval=5):
+        self.filename = filename
+        self.cachedir = cachedir
+        self.interval = interval
+        self.mtime = None
+        self.checked = time.time()
+        self.current = ncRuleSet()
+        if filename is not None:
+            self.mtime = os.stat(filename).st_mtime
+            self.current = ncRuleSet.load(filename, cachedir)
+            self.current.version = 1
+
+    def reload(self):
+        if self.filename is None:
+            return
+        try:
+            self.mtime = os.stat(self.filename).st_mtime
+            ruleset = ncRuleSet.load(self.filename, self.cachedir)
+        except Exception as e:
+            log.error('Reloading patch rules from %s failed, keeping version %d: %s',
+                      self.filename, self.current.version, str(e))
+            return
+        ruleset.version = self.current.version + 1
+        previous, self.current = self.current, ruleset
+        log.info('Patch rules version %d loaded from %s', ruleset.version, self.filename)
+        previous.report()
+
+    def check(self):
+        """
+        Reloads the rules if the file was modified, at most every interval.
+        """
+        now = time.time()
+        if self.filename is None or now - self.checked < self.interval:
+            return
+        self.checked = now
+        try:
+            if os.stat(self.filename).st_mtime != self.mtime:
+                self.reload()
+        except OSError as e:
+            log.error('Rules file %s: %s', self.filename, str(e))
+
+    def report(self):
+        self.current.report()
+
+
+class ncTransportPool(object):
+    """
+    Pool of authenticated SSH transports to NETCONF servers.
+
+    Transports are keyed by (host, port, username, credential fingerprint).
+    A new client session opens another netconf channel on a pooled transport
+    instead of running a new SSH handshake and authentication with the
+    server. Unused transports are closed after the idle timeout; transports
+    older than the maximum age are no longer handed out and are closed once
+    their last channel is released. With pooling disabled every acquire()
+    connects a new transport and every release() closes it.
+    """
+
+    def __init__(self, enabled=False, idle=60, maxage=3600, channels=8):
+        self.enabled = enabled
+        self.idle = idle
+        self.maxage = maxage
+        self.channels = channels
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.salt = os.urandom(16)
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+
+        if enabled:
+            reaper = threading.Thread(target=self.reaper, name='ncTransportPool')
+            reaper.daemon = True
+            reaper.start()
+
+    def fingerprint(self, *credentials):
+        """
+        Returns a salted hash of the credentials used to authenticate, so
+        sessions of different credentials never share a transport.
+        """
+        digest = hmac.new(self.salt, digestmod=hashlib.sha256)
+        for credential in credentials:
+            if credential is None:
+                credential = b''
+            elif not isinstance(credential, bytes):
+                credential = credential.encode('utf-8')
+            digest.update(credential + b'\0')
+        return digest.hexdigest()
+
+    def acquire(self, key, connect):
+        """
+        Returns a transport for key and whether it was reused. If no pooled
+        transport is available, connect() is called to create one.
+        """
+        if self.enabled:
+            now = time.time()
+            with self.lock:
+                for transport, entry in self.entries.items():
+                    if entry['key'] != key or entry['retired'] or entry['channels'] >= self.channels:
+                        continue
+                    if now - entry['created'] > self.maxage or not transport.is_active():
+                        continue
+                    entry['channels'] += 1
+                    self.reused += 1
+                    log.debug('Reusing transport to %s:%d (channels: %d)', key[0], key[1], entry['channels'])
+                    return transport, True
+
+        transport = connect()
+
+        if self.enabled:
+            transport.set_keepalive(30)
+            with self.lock:
+                self.entries[transport] = {
+                    'key': key, 'created': time.time(), 'released': time.time(),
+                    'channels': 1, 'retired': False}
+                self.created += 1
+        return transport, False
+
+    def release(self, transport, discard=False):
+        """
+        Returns a transport to the pool. If discard is set, the transport is
+        not handed out anymore and closed once unused.
+        """
+        with self.lock:
+            entry = self.entries.get(transport)
+            if entry is not None:
+                entry['channels'] -= 1
+                entry['released'] = time.time()
+                entry['retired'] |= discard or not transport.is_active()
+                if not entry['retired'] or entry['channels'] > 0:
+                    return
+                del self.entries[transport]
+                self.evicted += 1
+        transport.close()
+
+    def reaper(self):
+        while True:
+            time.sleep(max(1, min(self.idle, self.maxage) / 4.0))
+            now = time.time()
+            expired = []
+            with self.lock:
+                for transport, entry in list(self.entries.items()):
+                    if now - entry['created'] > self.maxage:
+                        entry['retired'] = True
+                    if entry['channels'] > 0:
+                        continue
+                    if entry['retired'] or now - entry['released'] > self.idle or not transport.is_active():
+                        del self.entries[transport]
+                        self.evicted += 1
+                        expired.append(transport)
+            for transport in expired:
+                log.debug('Closing pooled transport')
+                transport.close()
+
+    def report(self):
+        if self.enabled:
+            with self.lock:
+                log.info('transport pool: transports=%d created=%d reused=%d evicted=%d',
+                         len(self.entries), self.created, self.reused, self.evicted)
+
+
+class ncCapture(object):
+    """
+    Asynchronous writer for the NETCONF message capture.
+
+    Relay threads hand captured bytes to write() or complete messages to
+    message(), which only append them to a bounded in-memory queue. A single
+    writer thread takes everything queued at once and issues one write per
+    file, so disk latency never delays the relay. If the queue is full, the
+    relay thread waits or, with drop enabled, the data is dropped and counted.
+
+    Without a capture directory the server and client log file objects are
+    used. With a capture directory files are split per direction, session or
+    both, rotated by size and age and optionally compressed. The 'indexed'
+    format writes message records with a side index (see ncCaptureReader)
+    instead of the framed text stream.
+    """
+
+    SPLITS = ('none', 'direction', 'session', 'both')
+    COMPRESS = ('none', 'gzip', 'zstd')
+    FORMATS = ('text', 'indexed')
+
+    def __init__(self, serverlog=None, clientlog=None, directory=None, split='direction',
+                 rotatesize=0, rotatetime=0, compress='none', queuesize=64 * 1024 * 1024, drop=False,
+                 format='text'):
+        self.logs = {'server': serverlog, 'client': clientlog}
+        self.directory = directory
+        self.split = split
+        self.rotatesize = rotatesize
+        self.rotatetime = rotatetime
+        self.compress = compress
+        self.queuesize = queuesize
+        self.drop = drop
+        self.indexed = format == 'indexed'
+
+        if compress == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires the zstandard module')
+        if self.indexed and directory is None:
+            raise ValueError('indexed capture format requires a capture directory')
+        if directory is None and split != 'direction':
+            raise ValueError('capture split %s requires a capture directory' % split)
+        if directory is None and (rotatesize or rotatetime or compress != 'none'):
+            raise ValueError('capture rotation and compression require a capture directory')
+        if self.indexed and compress != 'none':
+            raise ValueError('indexed capture files can not be compressed')
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.cond = threading.Condition()
+        self.queue = []
+        self.queued = 0
+        self.stopped = False
+        self.files = {}
+        self.operations = {}
+        self.written = 0
+        self.dropped = 0
+        self.droppedbytes = 0
+
+        self.thread = threading.Thread(target=self.writer, name='ncCapture')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, session, direction, data):
+        """
+        Queues data captured in direction ('server' or 'client') of session.
+        Only used for the text format; the indexed format needs message().
+        """
+        self.enqueue((session, direction, data, None, None), len(data))
+
+    def message(self, session, direction, framed, msg):
+        """
+        Queues a complete message captured in direction of session, framed
+        as forwarded.
+        """
+        if self.indexed:
+            self.enqueue((session, direction, framed, msg, None), len(framed) + len(msg))
+        else:
+            self.enqueue((session, direction, framed, None, None), len(framed))
+
+    def enqueue(self, item, size):
+        with self.cond:
+            while self.queued and self.queued + size > self.queuesize:
+                if self.drop or self.stopped:
+                    self.dropped += 1
+                    self.droppedbytes += size
+                    return
+                self.cond.wait()
+            # --- timestamps are taken in queue order, so they never decrease
+            if item[3] is not None:
+                item = item[:4] + (time.time(),)
+            self.queue.append(item)
+            self.queued += size
+            self.cond.notify_all()
+
+    def close(self, session):
+        """
+        Closes the files of session, once everything queued is written.
+        """
+        with self.cond:
+            self.queue.append((session, None, None, None, None))
+            self.cond.notify_all()
+
+    def stop(self):
+        """
+        Writes everything queued, closes all files and stops the writer.
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def writer(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.stopped:
+                    self.cond.wait(self.rotatetime or None)
+                    if self.rotatetime:
+                        break
+                batch = self.queue
+                self.queue = []
+                self.queued = 0
+                stopped = self.stopped
+                self.cond.notify_all()
+
+            try:
+                self.flush(batch)
+                if self.rotatetime:
+                    self.expire()
+            except Exception as e:
+                log.error('Capture write failed: %s', str(e))
+                log.debug(''.join(traceback.format_exception(*sys.exc_info())))
+
+            if stopped:
+                for target in list(self.files):
+                    self.closefile(target)
+                return
+
+    def flush(self, batch):
+        pending = {}
+        order = []
+        for item in batch:
+            session, direction = item[0:2]
+            if direction is None:
+                self.writeall(pending, order)
+                pending, order = {}, []
+                for target in [t for t in self.files if t[0] == session]:
+                    self.closefile(target)
+                for key in [k for k in self.operations if k[0] == session]:
+                    del self.operations[key]
+                continue
+            target = self.target(session, direction)
+            if target not in pending:
+                pending[target] = []
+                order.append(target)
+            pending[target].append(item)
+        self.writeall(pending, order)
+
+    def writeall(self, pending, order):
+        for target in order:
+            if self.directory is None:
+                file = self.logs[target[1]]
+                size = self.output(file, [item[2] for item in pending[target]])
+                file.flush()
+            elif not self.indexed:
+                data = [item[2] for item in pending[target]]
+                entry = self.open(target, sum(len(buf) for buf in data))
+                size = self.output(entry['file'], data)
+                entry['size'] += size
+                if self.compress == 'none':
+                    entry['file'].flush()
+            else:
+                size = self.writerecords(target, pending[target])
+            self.written += size
+
+    @staticmethod
+    def output(file, data):
+        """
+        Writes the buffers in data, joined to save system calls unless
+        they include spooled messages, and returns the number of bytes.
+        """
+        if all(isinstance(buf, bytes) for buf in data):
+            buf = b''.join(data)
+            file.write(buf)
+            return len(buf)
+        for buf in data:
+            file.write(buf)
+        return sum(len(buf) for buf in data)
+
+    def writerecords(self, target, items):
+        """
+        Writes items as message records and index entries (indexed format).
+        """
+        records = []
+        for session, direction, framed, msg, timestamp in items:
+            msgtype, msgid, operation = nc_peek(msg)
+            if msgtype == 'rpc':
+                self.operations[(session, msgid)] = operation
+            elif msgtype == 'rpc-reply':
+                operation = self.operations.pop((session, msgid), '')
+            else:
+                operation = msgtype or ''
+            msgid = (msgid or '').encode('utf-8')
+            operation = operation.encode('utf-8')
+            records.append((session, direction, framed, msgid, operation, timestamp,
+                            NCAP_MSGTYPES.index(msgtype) if msgtype in NCAP_MSGTYPES else 0))
+
+        size = sum(NCAP_RECORD.size + len(r[2]) + len(r[3]) + len(r[4]) for r in records)
+        entry = self.open(target, size)
+        data, index = [], []
+        offset = entry['size']
+        for session, direction, framed, msgid, operation, timestamp, msgtype in records:
+            dirno = NCAP_DIRECTIONS.index(direction)
+            data.append(NCAP_RECORD.pack(len(framed), session, timestamp, dirno, msgtype, len(msgid), len(operation)))
+            data.append(msgid)
+            data.append(operation)
+            data.append(framed)
+            index.append(NCIX_ENTRY.pack(offset, timestamp, session, zlib.crc32(msgid), dirno, msgtype))
+            offset += NCAP_RECORD.size + len(msgid) + len(operation) + len(framed)
+
+        size = self.output(entry['file'], data)
+        entry['file'].flush()
+        entry['index'].write(b''.join(index))
+        entry['index'].flush()
+        entry['size'] = offset
+        return size
+
+    def target(self, session, direction):
+        if self.split == 'none':
+            return (None, 'capture')
+        if self.split == 'direction':
+            return (None, direction)
+        if self.split == 'session':
+            return (session, 'session')
+        return (session, direction)
+
+    def open(self, target, size):
+        """
+        Returns the open file entry for target, rotating it if it would
+        exceed the maximum file size.
+        """
+        entry = self.files.get(target)
+        if entry is not None and self.rotatesize and entry['size'] and entry['size'] + size > self.rotatesize:
+            self.closefile(target)
+            entry = None
+        if entry is None:
+            session, name = target
+            if session is not None:
+                if name == 'session':
+                    name = 'session-%s' % session
+                else:
+                    name = 'session-%s-%s' % (session, name)
+            name = os.path.join(self.directory, '%s-%s' % (name, time.strftime('%Y%m%d-%H%M%S')))
+            if self.indexed:
+                suffix = NCAP_SUFFIX
+            else:
+                suffix = {'none': '.log', 'gzip': '.log.gz', 'zstd': '.log.zst'}[self.compress]
+            filename, seq = name + suffix, 0
+            while not self.reserve(filename):
+                seq += 1
+                filename = '%s-%d%s' % (name, seq, suffix)
+            entry = {'opened': time.time(), 'size': 0}
+            if self.compress == 'gzip':
+                entry['file'] = gzip.open(filename, 'wb')
+            elif self.compress == 'zstd':
+                entry['file'] = zstandard.ZstdCompressor().stream_writer(open(filename, 'wb'))
+            else:
+                entry['file'] = open(filename, 'wb')
+            if self.indexed:
+                entry['file'].write(NCAP_MAGIC)
+                entry['size'] = len(NCAP_MAGIC)
+                entry['index'] = open(filename[:-len(NCAP_SUFFIX)] + NCIX_SUFFIX, 'wb')
+                entry['index'].write(NCIX_MAGIC)
+            log.debug('Capture file %s opened', filename)
+            self.files[target] = entry
+        return entry
+
+    @staticmethod
+    def reserve(filename):
+        """
+        Creates filename if it does not exist; with --workers several
+        processes capture into the same directory.
+        """
+        try:
+            os.close(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+            return True
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+
+    def closefile(self, target):
+        entry = self.files.pop(target)
+        entry['file'].close()
+        if 'index' in entry:
+            entry['index'].close()
+
+    def expire(self):
+        now = time.time()
+        for target, entry in list(self.files.items()):
+            if now - entry['opened'] >= self.rotatetime:
+                self.closefile(target)
+
+    def report(self):
+        with self.cond:
+            log.info('capture: written=%d queued=%d dropped=%d (%d bytes)',
+                     self.written, self.queued, self.dropped, self.droppedbytes)
+
+
+# --- indexed capture format -------------------------------------------------
+#
+# A capture file (.ncap) starts with NCAP_MAGIC followed by message records:
+# a NCAP_RECORD header (length of the framed message, session id, timestamp,
+# direction, message type, length of message-id and operation) followed by
+# the message-id, the operation name and the message as forwarded, framing
+# included. The side index (.ncidx) starts with NCIX_MAGIC followed by one
+# fixed size NCIX_ENTRY per record (record offset, timestamp, session id,
+# crc32 of the message-id, direction and message type) in timestamp order.
+
+NCAP_SUFFIX = '.ncap'
+NCAP_MAGIC = b'NCAP\x01\x00\x00\x00'
+NCAP_RECORD = struct.Struct('<IQdBBHH')
+NCAP_DIRECTIONS = ('client', 'server')
+NCAP_MSGTYPES = (None, 'hello', 'rpc', 'rpc-reply', 'notification')
+NCIX_SUFFIX = '.ncidx'
+NCIX_MAGIC = b'NCIX\x01\x00\x00\x00'
+NCIX_ENTRY = struct.Struct('<QdQIBB2x')
+
+ncCaptureRecord = collections.namedtuple('ncCaptureRecord', 'timestamp session direction msgtype msgid operation data')
+
+
+def nc_records(data, offset=len(NCAP_MAGIC)):
+    """
+    Yields offset and header of the complete records of capture data,
+    starting at offset.
+    """
+    while offset + NCAP_RECORD.size <= len(data):
+        header = NCAP_RECORD.unpack_from(data, offset)
+        size, session, timestamp, dirno, msgtype, idlen, oplen = header
+        end = offset + NCAP_RECORD.size + idlen + oplen + size
+        if end > len(data):
+            return
+        yield offset, header
+        offset = end
+
+
+def nc_reindex(filename):
+    """
+    Rebuilds the index of capture file filename from its records alone.
+    The index is written to a temporary file which replaces the old index,
+    so a corrupt index is never read. Returns the number of records.
+    """
+    if filename.endswith(NCIX_SUFFIX):
+        filename = filename[:-len(NCIX_SUFFIX)] + NCAP_SUFFIX
+    indexname = filename[:-len(NCAP_SUFFIX)] + NCIX_SUFFIX
+    count = 0
+    with open(filename, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if data[:len(NCAP_MAGIC)] != NCAP_MAGIC:
+            raise ValueError('%s is not a capture file' % filename)
+        with open(indexname + '.tmp', 'wb') as index:
+            index.write(NCIX_MAGIC)
+            for offset, (size, session, timestamp, dirno, msgtype, idlen, oplen) in nc_records(data):
+                msgid = data[offset + NCAP_RECORD.size:offset + NCAP_RECORD.size + idlen]
+                index.write(NCIX_ENTRY.pack(offset, timestamp, session, zlib.crc32(msgid), dirno, msgtype))
+                count += 1
+        os.replace(indexname + '.tmp', indexname)
+    finally:
+        data.close()
+    return count
+
+
+class ncCaptureReader(object):
+    """
+    Reads an indexed capture file. Data and index are memory-mapped; record
+    selection by time uses a binary search on the index, selection by session
+    and message-id only reads the index, so the data file is only touched
+    for the records returned. A missing or corrupt index, or one lacking
+    records of the data file, is rebuilt.
+    """
+
+    def __init__(self, filename):
+        if filename.endswith(NCIX_SUFFIX):
+            filename = filename[:-len(NCIX_SUFFIX)] + NCAP_SUFFIX
+        self.filename = filename
+        self.indexname = filename[:-len(NCAP_SUFFIX)] + NCIX_SUFFIX
+        with open(filename, 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(NCAP_MAGIC)] != NCAP_MAGIC:
+            raise ValueError('%s is not a capture file' % filename)
+        self.index = self.load()
+        if self.index is None:
+            nc_reindex(filename)
+            self.index = self.load()
+            if self.index is None:
+                raise ValueError('%s is not a capture index' % self.indexname)
+        self.count = (len(self.index) - len(NCIX_MAGIC)) // NCIX_ENTRY.size
+
+    def load(self):
+        """
+        Returns the mapped index, or None if it is missing, corrupt or ends
+        before the last complete record of the data file.
+        """
+        try:
+            with open(self.indexname, 'rb') as file:
+                index = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return None
+        size = len(index) - len(NCIX_MAGIC)
+        if index[:len(NCIX_MAGIC)] != NCIX_MAGIC or size % NCIX_ENTRY.size:
+            index.close()
+            return None
+        # --- the last indexed record must be the last complete record -----
+        records = nc_records(self.data)
+        if size:
+            last = NCIX_ENTRY.unpack_from(index, len(index) - NCIX_ENTRY.size)[0]
+            records = nc_records(self.data, last)
+            if next(records, (None,))[0] != last:
+                records = None
+        if records is None or next(records, None) is not None:
+            index.close()
+            return None
+        return index
+
+    def close(self):
+        self.index.close()
+        self.data.close()
+
+    def entry(self, idx):
+        return NCIX_ENTRY.unpack_from(self.index, len(NCIX_MAGIC) + idx * NCIX_ENTRY.size)
+
+    def bisect(self, timestamp):
+        """
+        Returns the number of records before timestamp.
+        """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid)[1] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def record(self, offset):
+        size, session, timestamp, dirno, msgtype, idlen, oplen = NCAP_RECORD.unpack_from(self.data, offset)
+        pos = offset + NCAP_RECORD.size
+        msgid = self.data[pos:pos + idlen].decode('utf-8')
+        operation = self.data[pos + idlen:pos + idlen + oplen].decode('utf-8')
+        pos += idlen + oplen
+        return ncCaptureRecord(timestamp, session, NCAP_DIRECTIONS[dirno], NCAP_MSGTYPES[msgtype],
+                               msgid, operation, self.data[pos:pos + size])
+
+    def select(self, session=None, since=None, until=None, msgid=None, direction=None):
+        """
+        Yields the records matching all given criteria in timestamp order.
+        """
+        lo, hi = 0, self.count
+        if since is not None:
+            lo = self.bisect(since)
+        if until is not None:
+            hi = self.bisect(until)
+        crc = dirno = None
+        if msgid is not None:
+            crc = zlib.crc32(msgid.encode('utf-8'))
+        if direction is not None:
+            dirno = NCAP_DIRECTIONS.index(direction)
+
+        # --- the index is read in blocks, never exporting the mmap buffer --
+        for block in range(lo, hi, 4096):
+            start = len(NCIX_MAGIC) + block * NCIX_ENTRY.size
+            end = len(NCIX_MAGIC) + min(block + 4096, hi) * NCIX_ENTRY.size
+            for offset, timestamp, sess, idcrc, dno, msgtype in NCIX_ENTRY.iter_unpack(self.index[start:end]):
+                if session is not None and sess != session:
+                    continue
+                if msgid is not None and idcrc != crc:
+                    continue
+                if direction is not None and dno != dirno:
+                    continue
+                record = self.record(offset)
+                if msgid is not None and record.msgid != msgid:
+                    continue
+                yield record
+
+
+class ncReplay(object):
+    """
+    Recorded request/response pairs served by the replay mode.
+
+    Requests are normalized (see nc_normalize) and indexed by their hash, so
+    a lookup costs one hash computation. Responses are returned with the
+    message-id of the request. Recordings are JSON lines files with one
+    {"request": ..., "response": ...} object per line (an object with a
+    "hello" key sets the server hello), or indexed capture files, in which
+    rpc and rpc-reply are paired by session and message-id.
+    """
+
+    HELLO = (b'<?xml version="1.0" encoding="UTF-8"?>'
+             b'<hello xmlns="urn:ietf:params:xml:ns:netconf:base:1.0"><capabilities>'
+             b'<capability>urn:ietf:params:netconf:base:1.0</capability>'
+             b'<capability>urn:ietf:params:netconf:base:1.1</capability>'
+             b'</capabilities><session-id>1</session-id></hello>')
+
+    ERROR = (b'<rpc-reply message-id="" xmlns="urn:ietf:params:xml:ns:netconf:base:1.0"><rpc-error>'
+             b'<error-type>application</error-type><error-tag>operation-not-supported</error-tag>'
+             b'<error-severity>error</error-severity><error-message>No recorded response</error-message>'
+             b'</rpc-error></rpc-reply>')
+
+    CLOSE = b'<rpc-reply message-id="" xmlns="urn:ietf:params:xml:ns:netconf:base:1.0"><ok/></rpc-reply>'
+
+    def __init__(self):
+        self.hello = self.HELLO
+        self.responses = {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def load(cls, filenames):
+        replay = cls()
+        captures = [f for f in filenames if f.endswith(NCAP_SUFFIX) or f.endswith(NCIX_SUFFIX)]
+        for filename in filenames:
+            if filename not in captures:
+                replay.load_jsonl(filename)
+        if captures:
+            replay.load_captures(captures)
+        log.info('Replay: %d recorded requests loaded', len(replay.responses))
+        return replay
+
+    def load_jsonl(self, filename):
+        with open(filename, 'r') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if 'hello' in record:
+                    self.hello = record['hello'].encode('utf-8')
+                else:
+                    self.add(record['request'].encode('utf-8'), record['response'].encode('utf-8'))
+
+    def load_captures(self, filenames):
+        """
+        Pairs rpc and rpc-reply records of the capture files. Files split by
+        direction are supported, so all requests are read first.
+        """
+        requests = {}
+        hello = None
+        for msgtype, direction in (('rpc', 'client'), ('rpc-reply', 'server'), ('hello', 'server')):
+            for filename in filenames:
+                reader = ncCaptureReader(filename)
+                try:
+                    for record in reader.select(direction=direction):
+                        if record.msgtype != msgtype:
+                            continue
+                        framer = ncFramer()
+                        framer.feed(record.data)
+                        msg = framer.pop()
+                        if msg is None:
+                            continue
+                        if msgtype == 'rpc':
+                            requests[(record.session, record.msgid)] = msg
+                        elif msgtype == 'rpc-reply':
+                            request = requests.pop((record.session, record.msgid), None)
+                            if request is not None:
+                                self.add(request, msg)
+                        elif hello is None:
+                            hello = msg
+                finally:
+                    reader.close()
+        if hello is not None:
+            self.hello = hello
+
+    def add(self, request, response):
+        key = hashlib.sha1(nc_normalize(request)).digest()
+        if key not in self.responses:
+            self.responses[key] = response
+
+    def lookup(self, request):
+        """
+        Returns the recorded response to request with the message-id of
+        request, or None if there is none.
+        """
+        response = self.responses.get(hashlib.sha1(nc_normalize(request)).digest())
+        if response is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return nc_messageid(response, nc_peek(request)[1])
+
+    def report(self):
+        log.info('replay: recorded=%d hits=%d misses=%d', len(self.responses), self.hits, self.misses)
+
+
+class ncResponseCache(object):
+    """
+    Cache of replies to read-only RPCs (--cache).
+
+    Requests of the configured operations are keyed by server, username and
+    the hash of the normalized request (see nc_normalize), so requests only
+    differing in message-id and whitespace share a reply. Entries expire
+    after ttl seconds; above maxsize bytes the least recently used entries
+    are evicted. Replies containing an <rpc-error> are not stored. An
+    INVALIDATE operation sent to a server drops all entries of the server,
+    when it is forwarded and again when its reply is received.
+
+    A request already in flight for another session is not forwarded: the
+    session waits for the reply to the first request (coalescing). If the
+    first session goes away before, the waiting sessions forward their
+    requests themselves.
+    """
+
+    INVALIDATE = frozenset(['edit-config', 'copy-config', 'delete-config', 'commit', 'discard-changes', 'cancel-commit'])
+    ERROR = re.compile(rb'<(?:[\w.-]+:)?rpc-error[\s>/]')
+
+    def __init__(self, operations=None, maxsize=64 * 1024 * 1024, ttl=60):
+        self.operations = frozenset(operations or ())
+        self.enabled = bool(self.operations)
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.inflight = {}
+        self.generations = collections.Counter()
+        self.stats = collections.Counter()
+
+    @staticmethod
+    def key(device, username, msg):
+        return device, username, hashlib.sha1(nc_normalize(msg)).digest()
+
+    def get(self, key, waiter):
+        """
+        Returns (reply, None) if a reply to the request of key is cached.
+        Otherwise, if the same request is in flight, waiter is added to its
+        waiters and (None, None) is returned. Else (None, flight) is
+        returned, and the caller must forward the request and pass flight
+        to complete() or abandon(). Waiters get 'reply' and 'done' set and
+        their 'wake' function called when the reply arrived.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] < now:
+                del self.entries[key]
+                self.size -= len(entry[0])
+                self.stats['expirations'] += 1
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[0], None
+            flight = self.inflight.get(key)
+            if flight is not None:
+                flight['waiters'].append(waiter)
+                self.stats['coalesced'] += 1
+                return None, None
+            self.stats['misses'] += 1
+            flight = self.inflight[key] = {'key': key, 'generation': self.generations[key[0]], 'waiters': []}
+            return None, flight
+
+    def complete(self, flight, reply):
+        """
+        Stores reply to the request of flight, unless the server was
+        invalidated meanwhile, and hands it to the waiters.
+        """
+        if len(reply) > self.maxsize:
+            self.abandon(flight)
+            return
+        if not isinstance(reply, bytes):
+            reply = bytes(reply)
+        key = flight['key']
+        with self.lock:
+            if self.inflight.get(key) is flight:
+                del self.inflight[key]
+            if self.generations[key[0]] == flight['generation'] and not self.ERROR.search(reply):
+                previous = self.entries.pop(key, None)
+                if previous is not None:
+                    self.size -= len(previous[0])
+                self.entries[key] = (reply, time.time() + self.ttl)
+                self.size += len(reply)
+                self.stats['stores'] += 1
+                while self.size > self.maxsize:
+                    data, expires = self.entries.popitem(last=False)[1]
+                    self.size -= len(data)
+                    self.stats['evictions'] += 1
+            waiters = flight['waiters']
+        self.resolve(waiters, reply)
+
+    def abandon(self, flight):
+        """
+        Gives up the request of flight; its waiters forward their requests.
+        """
+        with self.lock:
+            if self.inflight.get(flight['key']) is flight:
+                del self.inflight[flight['key']]
+            waiters = flight['waiters']
+        self.resolve(waiters, None)
+
+    @staticmethod
+    def resolve(waiters, reply):
+        for waiter in waiters:
+            waiter['reply'] = reply
+            waiter['done'] = True
+            waiter['wake']()
+
+    def invalidate(self, device):
+        """
+        Drops all entries of device. Requests in flight are not stored.
+        """
+        with self.lock:
+            self.generations[device] += 1
+            self.stats['invalidations'] += 1
+            for key in [key for key in self.entries if key[0] == device]:
+                self.size -= len(self.entries.pop(key)[0])
+            for key in [key for key in self.inflight if key[0] == device]:
+                del self.inflight[key]
+
+    def bypass(self):
+        with self.lock:
+            self.stats['bypassed'] += 1
+
+    def counters(self):
+        """
+        Returns the event counters and the current number of entries and
+        bytes.
+        """
+        with self.lock:
+            counters = collections.Counter(self.stats)
+            counters['entries'] = len(self.entries)
+            counters['bytes'] = self.size
+            return counters
+
+    def report(self):
+        if self.enabled:
+            counters = self.counters()
+            log.info('response cache: entries=%d bytes=%d hits=%d misses=%d coalesced=%d bypassed=%d stores=%d '
+                     'evictions=%d expirations=%d invalidations=%d',
+                     *[counters[name] for name in ('entries', 'bytes', 'hits', 'misses', 'coalesced', 'bypassed',
+                                                   'stores', 'evictions', 'expirations', 'invalidations')])
+
+
+def nc_priority(value):
+    """
+    Converts a priority class argument 'class:operation,...' into the class
+    name and the list of operations.
+    """
+    name, sep, operations = value.partition(':')
+    if not sep or name not in ncScheduler.CLASSES:
+        raise argparse.ArgumentTypeError('invalid priority class: %s' % value)
+    return name, [operation for operation in operations.split(',') if operation]
+
+
+class ncScheduler(object):
+    """
+    Scheduler of the rpcs forwarded to the servers (--ratelimit,
+    --maxoutstanding).
+
+    Per server rpcs are admitted at most at rate per second, in bursts of up
+    to burst rpcs (token bucket), and only while less than maxoutstanding
+    admitted rpcs wait for their reply. Other rpcs are queued in the
+    priority class of their operation; queues are served strictly by class,
+    in arrival order within a class. An admitted rpc is outstanding until
+    the reply with its message-id was received or its session ended. The
+    token buckets use the monotonic clock, so they are not disturbed by
+    changes of the system time.
+    """
+
+    CLASSES = ('high', 'normal', 'low')
+    PRIORITY = 'high:lock,unlock,edit-config,copy-config,delete-config,commit,discard-changes,cancel-commit,close-session,kill-session'
+
+    def __init__(self, rate=0, burst=10, maxoutstanding=0, priorities=()):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.maxoutstanding = maxoutstanding
+        self.enabled = bool(rate or maxoutstanding)
+        self.classes = {}
+        for name, operations in [nc_priority(self.PRIORITY)] + list(priorities):
+            for operation in operations:
+                self.classes[operation] = self.CLASSES.index(name)
+        self.cond = threading.Condition()
+        self.devices = {}
+        self.stats = collections.Counter()
+        if self.enabled and self.rate:
+            thread = threading.Thread(target=self.run, name='ncScheduler')
+            thread.daemon = True
+            thread.start()
+
+    def device(self, device):
+        state = self.devices.get(device)
+        if state is None:
+            state = self.devices[device] = {'name': '%s:%s' % device, 'tokens': float(self.burst),
+                                            'updated': time.monotonic(), 'outstanding': 0,
+                                            'queues': [collections.deque() for name in self.CLASSES]}
+        return state
+
+    def submit(self, device, job):
+        """
+        Returns True if the rpc of job ('operation') may be forwarded to
+        device at once. Otherwise the job is queued; 'done' is set and its
+        'wake' function called once it is admitted.
+        """
+        job['priority'] = self.classes.get(job['operation'], 1)
+        with self.cond:
+            state = self.device(device)
+            job['queued'] = time.monotonic()
+            if not any(state['queues']) and self.admit(state, job['queued']):
+                self.stats['admitted', state['name']] += 1
+                metrics.wait(job['operation'], 0)
+                return True
+            state['queues'][job['priority']].append(job)
+            self.stats['delayed', state['name']] += 1
+            self.cond.notify()
+            return False
+
+    def admit(self, state, now):
+        """
+        Takes a token and an outstanding slot of the server of state, if
+        both are available.
+        """
+        if self.rate:
+            state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * self.rate)
+            state['updated'] = now
+            if state['tokens'] < 1:
+                return False
+        if self.maxoutstanding and state['outstanding'] >= self.maxoutstanding:
+            return False
+        if self.rate:
+            state['tokens'] -= 1
+        state['outstanding'] += 1
+        return True
+
+    def dispatch(self, state):
+        """
+        Admits queued jobs of the server of state, highest class first.
+        Returns the seconds until the next token if jobs are left waiting
+        for one, else None.
+        """
+        now = time.monotonic()
+        while any(state['queues']):
+            if not self.admit(state, now):
+                if self.maxoutstanding and state['outstanding'] >= self.maxoutstanding:
+                    return None
+                return (1 - state['tokens']) / self.rate
+            job = next(queue for queue in state['queues'] if queue).popleft()
+            job['done'] = True
+            self.stats['admitted', state['name']] += 1
+            metrics.wait(job['operation'], now - job['queued'])
+            job['wake']()
+        return None
+
+    def release(self, device, count=1):
+        """
+        Frees the slots of count rpcs to device which were answered or whose
+        session ended.
+        """
+        with self.cond:
+            state = self.device(device)
+            state['outstanding'] = max(0, state['outstanding'] - count)
+            if self.dispatch(state) is not None:
+                self.cond.notify()
+
+    def cancel(self, device, job):
+        """
+        Gives up job as its session ended.
+        """
+        with self.cond:
+            state = self.device(device)
+            if job['done']:
+                state['outstanding'] = max(0, state['outstanding'] - 1)
+                if self.dispatch(state) is not None:
+                    self.cond.notify()
+                return
+            queues = state['queues']
+            queues[job['priority']] = collections.deque(other for other in queues[job['priority']] if other is not job)
+            self.stats['cancelled', state['name']] += 1
+
+    def run(self):
+        """
+        Admits queued jobs as tokens become available.
+        """
+        with self.cond:
+            while True:
+                timeout = None
+                for state in self.devices.values():
+                    delay = self.dispatch(state)
+                    if delay is not None and (timeout is None or delay < timeout):
+                        timeout = delay
+                self.cond.wait(timeout)
+
+    def counters(self):
+        """
+        Returns the event counters and the current number of queued and
+        outstanding rpcs, by (name, server).
+        """
+        with self.cond:
+            counters = collections.Counter(self.stats)
+            for state in self.devices.values():
+                counters['queued', state['name']] = sum(len(queue) for queue in state['queues'])
+                counters['outstanding', state['name']] = state['outstanding']
+            return counters
+
+    def report(self):
+        if self.enabled:
+            counters = self.counters()
+            for name in sorted(set(device for event, device in counters)):
+                log.info('scheduler %s: queued=%d outstanding=%d admitted=%d delayed=%d cancelled=%d', name,
+                         *[counters[event, name] for event in ('queued', 'outstanding', 'admitted', 'delayed', 'cancelled')])
+
+
+class ncFanout(object):
+    """
+    Notification subscriptions shared by client sessions (--fanout).
+
+    A <create-subscription> rpc without replay (startTime) is keyed by
+    server, username and the hash of the normalized request, so requests of
+    the same stream and filter share a key. For the first one the proxy
+    opens a subscription session of its own to the server; later rpcs with
+    the same key are answered by the proxy, and every <notification> of the
+    subscription session is copied to all sessions subscribed. A session
+    queues up to maxqueue bytes of notifications; if it does not keep up,
+    the oldest or the newest notifications are dropped, or the session is
+    disconnected (drop). The subscription session is closed together with
+    the last session subscribed; if the server closes it, the sessions
+    subscribed are disconnected.
+    """
+
+    DROP = ('oldest', 'newest', 'disconnect')
+    REPLAY = re.compile(rb'<(?:[\w.-]+:)?(?:startTime|stopTime)[\s>/]')
+    HELLO = (b'<?xml version="1.0" encoding="UTF-8"?>'
+             b'<hello xmlns="urn:ietf:params:xml:ns:netconf:base:1.0"><capabilities>'
+             b'<capability>urn:ietf:params:netconf:base:1.0</capability>%s'
+             b'</capabilities></hello>')
+
+    def __init__(self, enabled=False, maxqueue=1024 * 1024, drop='oldest'):
+        self.enabled = enabled
+        self.maxqueue = maxqueue
+        self.drop = drop
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+        self.msgids = itertools.count(1)
+        self.stats = collections.Counter()
+
+    @staticmethod
+    def key(device, username, msg):
+        """
+        Returns the key of a create-subscription rpc which can be shared,
+        else None.
+        """
+        msgtype, msgid, operation = nc_peek(msg)
+        if msgtype != 'rpc' or msgid is None or operation != 'create-subscription' or ncFanout.REPLAY.search(msg):
+            return None
+        return device, username, hashlib.sha1(nc_normalize(msg)).digest()
+
+    def subscribe(self, key, subscriber, poolkey, connect):
+        """
+        Adds subscriber, a client session, to the subscription of key and
+        returns the reply to its rpc if the subscription is established.
+        Otherwise None is returned, the subscription session is opened (with
+        a transport acquired from the pool by poolkey and connect) if needed,
+        and the subscriber gets 'reply' and 'done' set and its 'wake'
+        function called once the server answered. A 'reply' of None means
+        the subscription session failed and the rpc must be forwarded.
+        """
+        with self.lock:
+            subscription = self.subscriptions.get(key)
+            subscriber['subscription'] = subscription
+            if subscription is not None and subscription['reply'] is not None:
+                subscription['subscribers'].append(subscriber)
+                self.stats['shared'] += 1
+                return subscription['reply']
+            if subscription is None:
+                subscription = self.subscriptions[key] = {'key': key, 'reply': None, 'channel': None,
+                                                          'subscribers': [], 'waiters': []}
+                subscriber['subscription'] = subscription
+                thread = threading.Thread(target=self.run, args=(subscription, subscriber['msg'], poolkey, connect),
+                                          name='ncFanout-%s:%s' % key[0])
+                thread.daemon = True
+                thread.start()
+            else:
+                self.stats['shared'] += 1
+            subscription['waiters'].append(subscriber)
+            return None
+
+    def unsubscribe(self, subscriber):
+        """
+        Removes subscriber as its session ended; the subscription session is
+        closed with the last subscriber.
+        """
+        with self.lock:
+            subscription = subscriber.get('subscription')
+            if subscription is None:
+                return
+            subscriber['subscription'] = None
+            for name in ('subscribers', 'waiters'):
+                subscription[name] = [other for other in subscription[name] if other is not subscriber]
+            if subscription['subscribers'] or subscription['waiters']:
+                return
+            if self.subscriptions.get(subscription['key']) is subscription:
+                del self.subscriptions[subscription['key']]
+            channel = subscription['channel']
+        if channel is not None:
+            channel.close()
+
+    @staticmethod
+    def receive(channel, framer):
+        while True:
+            msg = framer.pop()
+            if msg is not None:
+                return msg
+            data = channel.recv(65535)
+            if not data:
+                return None
+            framer.feed(data)
+
+    def run(self, subscription, request, poolkey, connect):
+        """
+        Runs the subscription session: sends the first create-subscription
+        rpc and hands the notifications received to the subscribers.
+        """
+        name = '%s:%s' % subscription['key'][0]
+        transport = channel = None
+        reply = None
+        try:
+            transport = pool.acquire(poolkey, connect)[0]
+            channel = transport.open_session()
+            channel.invoke_subsystem('netconf')
+            framer = ncFramer(options.maxbuffer)
+            hello = self.receive(channel, framer)
+            if hello is None:
+                raise EOFError('no hello received')
+            base11 = b'urn:ietf:params:netconf:base:1.1' in hello
+            capability = b'<capability>urn:ietf:params:netconf:base:1.1</capability>' if base11 else b''
+            nc_send(channel, framer.frame(self.HELLO % capability, base10=True))
+            msgid = 'ncproxy-fanout-%d' % next(self.msgids)
+            nc_send(channel, framer.frame(nc_messageid(request, msgid), base10=not base11))
+            reply = self.receive(channel, framer)
+            if reply is None:
+                raise EOFError('no reply to create-subscription received')
+
+            with self.lock:
+                waiters = subscription['waiters']
+                subscription['waiters'] = []
+                if waiters and not ncResponseCache.ERROR.search(reply):
+                    subscription['reply'] = reply
+                    subscription['channel'] = channel
+                    subscription['subscribers'].extend(waiters)
+                    self.stats['subscriptions'] += 1
+                elif self.subscriptions.get(subscription['key']) is subscription:
+                    del self.subscriptions[subscription['key']]
+            ncResponseCache.resolve(waiters, reply)
+            if subscription['reply'] is None:
+                log.info('Subscription to %s not shared: %s', name, 'rejected' if waiters else 'no subscribers left')
+                return
+            log.info('Subscription to %s established', name)
+
+            while True:
+                msg = self.receive(channel, framer)
+                if msg is None:
+                    break
+                if nc_peek(msg)[0] == 'notification':
+                    self.publish(subscription, msg)
+
+        except Exception as e:
+            log.warning('Subscription session to %s failed: %s', name, str(e))
+
+        finally:
+            with self.lock:
+                if self.subscriptions.get(subscription['key']) is subscription:
+                    del self.subscriptions[subscription['key']]
+                subscribers, waiters = subscription['subscribers'], subscription['waiters']
+                subscription['subscribers'], subscription['waiters'] = [], []
+                for subscriber in subscribers + waiters:
+                    subscriber['subscription'] = None
+            # --- the sessions waiting forward their rpcs themselves ---------
+            ncResponseCache.resolve(waiters, None)
+            if subscribers:
+                log.warning('Subscription session to %s closed, disconnecting %d sessions', name, len(subscribers))
+            for subscriber in subscribers:
+                subscriber['closed'] = True
+                subscriber['wake']()
+            if channel is not None:
+                channel.close()
+            if transport is not None:
+                pool.release(transport)
+
+    def publish(self, subscription, msg):
+        """
+        Queues a notification for the subscribers of subscription.
+        """
+        if not isinstance(msg, bytes):
+            msg = bytes(msg)
+        with self.lock:
+            self.stats['notifications'] += 1
+            for subscriber in subscription['subscribers']:
+                if subscriber['closed']:
+                    continue
+                queue = subscriber['queue']
+                if queue and subscriber['size'] + len(msg) > self.maxqueue:
+                    if self.drop == 'disconnect':
+                        log.warning('Notifications of %s not read, disconnecting', subscriber['name'])
+                        subscriber['closed'] = True
+                        self.stats['disconnected'] += 1
+                        subscriber['wake']()
+                        continue
+                    if self.drop == 'newest':
+                        self.stats['dropped'] += 1
+                        continue
+                    while queue and subscriber['size'] + len(msg) > self.maxqueue:
+                        subscriber['size'] -= len(queue.popleft())
+                        self.stats['dropped'] += 1
+                queue.append(msg)
+                subscriber['size'] += len(msg)
+                self.stats['delivered'] += 1
+                subscriber['wake']()
+
+    def pop(self, subscriber):
+        """
+        Returns the next notification queued for subscriber, or None.
+        """
+        with self.lock:
+            if not subscriber['queue']:
+                return None
+            msg = subscriber['queue'].popleft()
+            subscriber['size'] -= len(msg)
+            return msg
+
+    def counters(self):
+        """
+        Returns the event counters and the current number of subscription
+        sessions, subscribers and queued bytes.
+        """
+        with self.lock:
+            counters = collections.Counter(self.stats)
+            subscriptions = [subscription for subscription in self.subscriptions.values() if subscription['reply'] is not None]
+            counters['active'] = len(subscriptions)
+            counters['subscribers'] = sum(len(subscription['subscribers']) for subscription in subscriptions)
+            counters['bytes'] = sum(subscriber['size'] for subscription in subscriptions
+                                    for subscriber in subscription['subscribers'])
+            return counters
+
+    def report(self):
+        if self.enabled:
+            counters = self.counters()
+            log.info('notification fan-out: subscriptions=%d subscribers=%d bytes=%d opened=%d shared=%d '
+                     'notifications=%d delivered=%d dropped=%d disconnected=%d',
+                     *[counters[name] for name in ('active', 'subscribers', 'bytes', 'subscriptions', 'shared',
+                                                   'notifications', 'delivered', 'dropped', 'disconnected')])
+
+
+class ncRoutes(object):
+    """
+    Routing table mapping client sessions to NETCONF servers, so a single
+    ncproxy serves many devices.
+
+    Routes are selected by the username convention '<username>@<device>',
+    by username or by the TCP port the client connected to, in this order;
+    sessions matching no route use the default server, if given. The table
+    is a JSON file:
+
+        {"routes": [
+            {"device": "olt1", "server": "netconf://10.0.0.1:830",
+             "serverhostkey": "olt1.key", "serverhostkeyalg": "ECDSA"},
+            {"username": "olt2-admin", "server": "10.0.0.2", "serverusername": "admin"},
+            {"port": 8302, "server": "10.0.0.3"}]}
+
+    The file is reloaded when modified or on reload(); a table failing to
+    load is rejected and the previous table is kept.
+    """
+
+    def __init__(self, filename=None, default=None, interval=5):
+        self.filename = filename
+        self.default = default
+        self.interval = interval
+        self.mtime = None
+        self.checked = time.time()
+        self.table = ({}, {}, {})
+        if filename is not None:
+            self.mtime = os.stat(filename).st_mtime
+            self.table = self.parse(filename)
+
+    @staticmethod
+    def target(server, hostkey=None):
+        if server.find('://') == -1:
+            server = "netconf://" + server
+        url = urlparse(server)
+        if url.scheme != "netconf" or not url.hostname:
+            raise ValueError('invalid NETCONF server %s' % server)
+        return {'name': url.netloc, 'hostname': url.hostname, 'port': url.port or 830, 'hostkey': hostkey}
+
+    def parse(self, filename):
+        with open(filename, 'r') as file:
+            table = json.load(file)
+        devices, usernames, ports = {}, {}, {}
+        for route in table.get('routes', []):
+            hostkey = None
+            if 'serverhostkey' in route:
+                hostkey = nc_loadkey(route['serverhostkey'], route.get('serverhostkeyalg', 'RSA'))
+            target = self.target(route['server'], hostkey)
+            target['username'] = route.get('serverusername')
+            if 'device' in route:
+                devices[route['device']] = target
+            elif 'username' in route:
+                usernames[route['username']] = target
+            elif 'port' in route:
+                ports[int(route['port'])] = target
+            else:
+                raise ValueError('route without device, username or port: %s' % route)
+        log.info('Routes loaded: %d devices, %d usernames, %d ports', len(devices), len(usernames), len(ports))
+        return devices, usernames, ports
+
+    def reload(self):
+        if self.filename is None:
+            return
+        try:
+            self.mtime = os.stat(self.filename).st_mtime
+            self.table = self.parse(self.filename)
+        except Exception as e:
+            log.error('Reloading routes from %s failed: %s', self.filename, str(e))
+
+    def check(self):
+        """
+        Reloads the table if the file was modified, at most every interval.
+        """
+        now = time.time()
+        if self.filename is None or now - self.checked < self.interval:
+            return
+        self.checked = now
+        try:
+            if os.stat(self.filename).st_mtime != self.mtime:
+                self.reload()
+        except OSError as e:
+            log.error('Routes file %s: %s', self.filename, str(e))
+
+    def ports(self):
+        return set(self.table[2])
+
+    def lookup(self, port, username):
+        """
+        Returns the target server and the username to use towards it, or
+        (None, None) if no route matches.
+        """
+        devices, usernames, ports = self.table
+        if '@' in username:
+            user, device = username.rsplit('@', 1)
+            if device in devices:
+                target = devices[device]
+                return target, target['username'] or user
+        if username in usernames:
+            target = usernames[username]
+            return target, target['username'] or username
+        if port in ports:
+            target = ports[port]
+            return target, target['username'] or username
+        if self.default is not None:
+            return self.default, username
+        return None, None
+
+
+class ncAdmission(object):
+    """
+    Admission control for incoming client connections.
+
+    Accepted connections wait in a bounded queue for one of a fixed number
+    of handshake workers, which run the SSH handshake and the client
+    authentication (including the connection to the NETCONF server). Each
+    connection has a deadline counted from accept: connections still queued
+    or not authenticated at their deadline are closed. Connections are
+    rejected right away if the queue is full or the maximum number of
+    sessions (established, in handshake and queued) is reached.
+    """
+
+    def __init__(self, handshake, workers=16, queuesize=128, deadline=30, maxsessions=0):
+        self.handshake = handshake
+        self.queuesize = queuesize
+        self.deadline = deadline
+        self.maxsessions = maxsessions
+        self.lock = threading.Condition()
+        self.pending = collections.deque()
+        self.transports = set()
+        self.inprogress = 0
+        self.accepted = 0
+        self.established = 0
+        self.rejected = 0
+        self.expired = 0
+        self.failed = 0
+
+        for idx in range(workers):
+            worker = threading.Thread(target=self.worker, name='ncAdmission-%d' % idx)
+            worker.daemon = True
+            worker.start()
+
+    def sessions(self):
+        for transport in [t for t in self.transports if not t.is_active()]:
+            self.transports.discard(transport)
+        return len(self.transports) + self.inprogress + len(self.pending)
+
+    def submit(self, client, addr, port):
+        """
+        Queues an accepted client connection for the handshake workers.
+        """
+        now = time.time()
+        with self.lock:
+            self.accepted += 1
+            stale = self.purge(now)
+            if self.maxsessions and self.sessions() >= self.maxsessions:
+                reason = 'session limit %d reached' % self.maxsessions
+            elif len(self.pending) >= self.queuesize:
+                reason = 'handshake queue full'
+            else:
+                self.pending.append((now + self.deadline, client, addr, port))
+                self.lock.notify()
+                reason = None
+            if reason is not None:
+                self.rejected += 1
+
+        for item in stale:
+            self.reject(item, 'deadline passed in handshake queue')
+        if reason is not None:
+            self.reject((now, client, addr, port), reason)
+
+    def purge(self, now):
+        stale = []
+        while self.pending and self.pending[0][0] <= now:
+            stale.append(self.pending.popleft())
+            self.expired += 1
+        return stale
+
+    def reject(self, item, reason):
+        deadline, client, addr, port = item
+        log.warning('Rejecting client connection from %s (srcport: %d, port: %d): %s', addr[0], addr[1], port, reason)
+        try:
+            client.close()
+        except Exception:
+            pass
+
+    def worker(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.lock.wait()
+                stale = self.purge(time.time())
+                item = self.pending.popleft() if self.pending else None
+                if item is not None:
+                    self.inprogress += 1
+
+            for expired in stale:
+                self.reject(expired, 'deadline passed in handshake queue')
+            if item is None:
+                continue
+
+            deadline, client, addr, port = item
+            transport = None
+            try:
+                transport = self.handshake(client, port, deadline)
+            except Exception as e:
+                log.warning('Connection from %s failed: %s', addr[0], str(e))
+                try:
+                    client.close()
+                except Exception:
+                    pass
+
+            with self.lock:
+                self.inprogress -= 1
+                if transport is not None:
+                    self.transports.add(transport)
+                    self.established += 1
+                else:
+                    self.failed += 1
+
+    def report(self):
+        with self.lock:
+            log.info('admission: sessions=%d handshakes=%d queued=%d accepted=%d established=%d rejected=%d expired=%d failed=%d',
+                     self.sessions(), self.inprogress, len(self.pending), self.accepted,
+                     self.established, self.rejected, self.expired, self.failed)
+
+
+class ncMetrics(object):
+    """
+    RPC latency and throughput metrics.
+
+    Client <rpc> messages are matched by message-id with the <rpc-reply>
+    of the server. For every operation three latency histograms are kept:
+    the time from receiving the rpc until the reply was forwarded to the
+    client (rpc), the part of it the server took from the rpc being
+    forwarded until its reply was received (server), and the remainder
+    spent in the proxy (proxy), which includes the time the rpc was queued
+    by the scheduler (queue). Furthermore bytes and messages per session
+    and direction, framing errors and the time spent in rule evaluation and
+    in sending to the channels are counted.
+
+    Metrics are served in Prometheus text format on a localhost HTTP port
+    and/or dumped periodically to a JSON file.
+    """
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    MAXPENDING = 1000
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.httpd = None
+        self.pipe = None
+        self.started = time.time()
+        self.sessions = {}
+        self.pending = {}
+        self.bytes = collections.Counter()
+        self.messages = collections.Counter()
+        self.errors = collections.Counter()
+        self.ruleseconds = collections.Counter()
+        self.sendseconds = collections.Counter()
+        self.pauses = collections.Counter()
+        self.histograms = {'rpc': {}, 'server': {}, 'proxy': {}, 'queue': {}}
+        self.cache = None
+        self.cachestats = collections.Counter()
+        self.scheduler = None
+        self.schedstats = collections.Counter()
+        self.fanout = None
+        self.fanoutstats = collections.Counter()
+
+    def transfer(self, session, direction, size, seconds):
+        """
+        Accounts size bytes sent to the peer of direction in seconds.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.bytes[direction] += size
+            self.sendseconds[direction] += seconds
+            self.sessions.setdefault(session, collections.Counter())[direction, 'bytes'] += size
+
+    def message(self, session, direction, msg, received=None, forwarding=None, forwarded=None):
+        """
+        Accounts a message of direction: received is the time it was
+        complete (None if created by the proxy), forwarding the time rule
+        evaluation finished and forwarded the time it was sent (None if
+        not forwarded).
+        """
+        if not self.enabled:
+            return
+        msgtype, msgid, operation = nc_peek(msg)
+        if msgtype not in NCAP_MSGTYPES:
+            msgtype = 'other'
+        with self.lock:
+            self.messages[direction, msgtype] += 1
+            self.sessions.setdefault(session, collections.Counter())[direction, 'messages'] += 1
+            if received is not None and forwarding is not None:
+                self.ruleseconds[direction] += forwarding - received
+            if msgid is None:
+                return
+
+            if direction == 'client' and msgtype == 'rpc':
+                pending = self.pending.setdefault(session, collections.OrderedDict())
+                pending[msgid] = (operation or 'unknown', received, forwarded)
+                if len(pending) > self.MAXPENDING:
+                    pending.popitem(last=False)
+
+            elif direction == 'server' and msgtype == 'rpc-reply' and forwarded is not None:
+                request = self.pending.get(session, {}).pop(msgid, None)
+                if request is None or request[1] is None:
+                    return
+                operation, start, sent = request
+                self.observe('rpc', operation, forwarded - start)
+                if sent is not None and received is not None:
+                    self.observe('server', operation, received - sent)
+                    self.observe('proxy', operation, (forwarded - start) - (received - sent))
+
+    def observe(self, name, operation, seconds):
+        histogram = self.histograms[name].get(operation)
+        if histogram is None:
+            histogram = self.histograms[name][operation] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+        histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+    def error(self, direction):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.errors[direction] += 1
+
+    def pause(self, direction):
+        """
+        Accounts reading being paused as the data of direction is queued.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.pauses[direction] += 1
+
+    def wait(self, operation, seconds):
+        """
+        Accounts seconds an rpc of operation was queued by the scheduler.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.observe('queue', operation or 'unknown', seconds)
+
+    def close(self, session):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.sessions.pop(session, None)
+            self.pending.pop(session, None)
+
+    def cachecounters(self):
+        """
+        Returns the counters of the response cache, merged from the workers
+        or taken from the cache of this process.
+        """
+        counters = collections.Counter(self.cachestats)
+        if self.cache is not None:
+            counters.update(self.cache.counters())
+        return counters
+
+    def schedcounters(self):
+        """
+        Returns the counters of the scheduler by (name, server), merged from
+        the workers or taken from the scheduler of this process.
+        """
+        counters = collections.Counter(self.schedstats)
+        if self.scheduler is not None:
+            counters.update(self.scheduler.counters())
+        return counters
+
+    def fanoutcounters(self):
+        """
+        Returns the counters of the notification fan-out, merged from the
+        workers or taken from this process.
+        """
+        counters = collections.Counter(self.fanoutstats)
+        if self.fanout is not None:
+            counters.update(self.fanout.counters())
+        return counters
+
+    def state(self):
+        """
+        Returns the metrics as JSON serializable state, to be merged by the
+        master process of --workers.
+        """
+        cache = dict(self.cachecounters())
+        scheduler = [list(key) + [value] for key, value in self.schedcounters().items()]
+        fanout = dict(self.fanoutcounters())
+        with self.lock:
+            return {
+                'cache': cache, 'scheduler': scheduler, 'fanout': fanout,
+                'bytes': dict(self.bytes), 'errors': dict(self.errors),
+                'ruleseconds': dict(self.ruleseconds), 'sendseconds': dict(self.sendseconds),
+                'pauses': dict(self.pauses),
+                'messages': [list(key) + [value] for key, value in self.messages.items()],
+                'sessions': [[session] + list(key) + [value]
+                             for session, counters in self.sessions.items() for key, value in counters.items()],
+                'pending': [[session, len(pending)] for session, pending in self.pending.items()],
+                'histograms': dict((name, dict((operation, list(histogram)) for operation, histogram in histograms.items()))
+                                   for name, histograms in self.histograms.items())}
+
+    def add(self, state):
+        for name in ('bytes', 'errors', 'ruleseconds', 'sendseconds', 'pauses'):
+            getattr(self, name).update(state[name])
+        self.cachestats.update(state['cache'])
+        for name, device, value in state['scheduler']:
+            self.schedstats[name, device] += value
+        self.fanoutstats.update(state['fanout'])
+        for direction, msgtype, value in state['messages']:
+            self.messages[direction, msgtype] += value
+        for session, direction, unit, value in state['sessions']:
+            self.sessions.setdefault(session, collections.Counter())[direction, unit] += value
+        for session, count in state['pending']:
+            # --- only the number of rpcs waiting for a reply is known -------
+            self.pending[session] = dict.fromkeys(range(count))
+        for name, histograms in state['histograms'].items():
+            for operation, histogram in histograms.items():
+                total = self.histograms[name].setdefault(operation, [0] * len(histogram))
+                for idx, value in enumerate(histogram):
+                    total[idx] += value
+
+    def merge(self, states):
+        """
+        Replaces the metrics by the sum of states.
+        """
+        merged = ncMetrics(True)
+        for state in states:
+            merged.add(state)
+        with self.lock:
+            for name in ('sessions', 'pending', 'bytes', 'messages', 'errors', 'ruleseconds', 'sendseconds', 'pauses',
+                         'histograms', 'cachestats', 'schedstats', 'fanoutstats'):
+                setattr(self, name, getattr(merged, name))
+
+    def publish(self, fd, interval=1):
+        """
+        Sends the state to the master process of --workers through file
+        descriptor fd every interval seconds.
+        """
+        self.pipe = os.fdopen(fd, 'w')
+        self.pipelock = threading.Lock()
+
+        def publisher():
+            while self.pipe is not None:
+                self.send()
+                time.sleep(interval)
+
+        thread = threading.Thread(target=publisher, name='ncMetrics-publish')
+        thread.daemon = True
+        thread.start()
+
+    def send(self):
+        if self.pipe is None:
+            return
+        data = json.dumps(self.state()) + '\n'
+        try:
+            with self.pipelock:
+                self.pipe.write(data)
+                self.pipe.flush()
+        except (IOError, OSError, ValueError) as e:
+            log.debug('Sending metrics to master failed: %s', str(e))
+            self.pipe = None
+
+    def quantile(self, histogram, q):
+        """
+        Returns the upper bound of the bucket holding quantile q.
+        """
+        count = sum(histogram[:-1])
+        if not count:
+            return None
+        total = 0
+        for idx, value in enumerate(histogram[:-1]):
+            total += value
+            if total >= q * count:
+                return self.BUCKETS[idx] if idx < len(self.BUCKETS) else None
+
+    def snapshot(self):
+        cache = dict(self.cachecounters())
+        scheduler = dict(('%s/%s' % key, value) for key, value in self.schedcounters().items())
+        fanout = dict(self.fanoutcounters())
+        with self.lock:
+            latency = {}
+            for name, histograms in self.histograms.items():
+                latency[name] = {}
+                for operation, histogram in histograms.items():
+                    latency[name][operation] = {
+                        'count': sum(histogram[:-1]), 'sum': histogram[-1],
+                        'p50': self.quantile(histogram, 0.5), 'p99': self.quantile(histogram, 0.99),
+                        'buckets': dict(zip([str(le) for le in self.BUCKETS + ('+Inf',)], itertools.accumulate(histogram[:-1])))}
+            return {
+                'timestamp': time.time(),
+                'uptime': time.time() - self.started,
+                'bytes': dict(self.bytes),
+                'messages': dict(('%s/%s' % key, value) for key, value in self.messages.items()),
+                'framing_errors': dict(self.errors),
+                'rule_seconds': dict(self.ruleseconds),
+                'send_seconds': dict(self.sendseconds),
+                'backpressure_pauses': dict(self.pauses),
+                'sessions': dict((str(session), dict(('%s/%s' % key, value) for key, value in counters.items()))
+                                 for session, counters in self.sessions.items()),
+                'pending_rpcs': sum(len(pending) for pending in self.pending.values()),
+                'cache': cache,
+                'scheduler': scheduler,
+                'fanout': fanout,
+                'latency': latency}
+
+    def prometheus(self):
+        """
+        Returns the metrics in Prometheus text exposition format.
+        """
+        out = []
+
+        def metric(name, kind, text, samples):
+            out.append('# HELP ncproxy_%s %s' % (name, text))
+            out.append('# TYPE ncproxy_%s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                labels = ','.join('%s="%s"' % (key, str(label).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for key, label in labels)
+                out.append('ncproxy_%s%s%s %r' % (name, suffix, labels and '{' + labels + '}', float(value)))
+
+        def counter(name, text, counters):
+            metric(name, 'counter', text, [('', (('direction', key),), value) for key, value in sorted(counters.items())])
+
+        cache = self.cachecounters()
+        if cache:
+            metric('cache_events_total', 'counter', 'Response cache events.',
+                   [('', (('event', key),), value) for key, value in sorted(cache.items()) if key not in ('entries', 'bytes')])
+            metric('cache_entries', 'gauge', 'Replies in the response cache.', [('', (), cache['entries'])])
+            metric('cache_bytes', 'gauge', 'Size of the replies in the response cache.', [('', (), cache['bytes'])])
+
+        scheduler = self.schedcounters()
+        if scheduler:
+            metric('scheduler_events_total', 'counter', 'RPCs admitted, delayed and cancelled by the scheduler, by server.',
+                   [('', (('event', key[0]), ('server', key[1])), value)
+                    for key, value in sorted(scheduler.items()) if key[0] not in ('queued', 'outstanding')])
+            for name, text in (('queued', 'RPCs queued by the scheduler, by server.'),
+                               ('outstanding', 'RPCs admitted by the scheduler waiting for a reply, by server.')):
+                metric('scheduler_%s' % name, 'gauge', text,
+                       [('', (('server', key[1]),), value) for key, value in sorted(scheduler.items()) if key[0] == name])
+
+        fanout = self.fanoutcounters()
+        if fanout:
+            metric('fanout_events_total', 'counter', 'Notification fan-out events.',
+                   [('', (('event', key),), value) for key, value in sorted(fanout.items())
+                    if key not in ('active', 'subscribers', 'bytes')])
+            metric('fanout_subscriptions', 'gauge', 'Shared subscription sessions to servers.', [('', (), fanout['active'])])
+            metric('fanout_subscribers', 'gauge', 'Client sessions of shared subscriptions.', [('', (), fanout['subscribers'])])
+            metric('fanout_queued_bytes', 'gauge', 'Notifications queued for client sessions.', [('', (), fanout['bytes'])])
+
+        with self.lock:
+            metric('sessions', 'gauge', 'Active NETCONF sessions.', [('', (), len(self.sessions))])
+            metric('rpcs_pending', 'gauge', 'RPCs waiting for a reply.',
+                   [('', (), sum(len(pending) for pending in self.pending.values()))])
+            counter('bytes_total', 'Bytes forwarded, by sender.', self.bytes)
+            metric('messages_total', 'counter', 'Messages forwarded, by sender and message type.',
+                   [('', (('direction', key[0]), ('type', key[1])), value) for key, value in sorted(self.messages.items())])
+            counter('framing_errors_total', 'NETCONF framing errors, by sender.', self.errors)
+            counter('rule_seconds_total', 'Time spent in rule evaluation, by sender.', self.ruleseconds)
+            counter('send_seconds_total', 'Time spent sending to channels, by sender.', self.sendseconds)
+            counter('backpressure_pauses_total', 'Reading paused as sent data is queued, by sender.', self.pauses)
+            for unit in ('bytes', 'messages'):
+                metric('session_%s_total' % unit, 'counter', '%s forwarded per active session, by sender.' % unit.capitalize(),
+                       [('', (('session', session), ('direction', key[0])), value)
+                        for session, counters in sorted(self.sessions.items())
+                        for key, value in sorted(counters.items()) if key[1] == unit])
+
+            for name, text in (('rpc', 'RPC latency from request received to reply forwarded.'),
+                               ('server', 'RPC latency of the server, from request forwarded to reply received.'),
+                               ('proxy', 'RPC latency added by the proxy.'),
+                               ('queue', 'Time RPCs were queued by the scheduler.')):
+                samples = []
+                for operation, histogram in sorted(self.histograms[name].items()):
+                    for le, count in zip(self.BUCKETS + ('+Inf',), itertools.accumulate(histogram[:-1])):
+                        samples.append(('_bucket', (('operation', operation), ('le', le)), count))
+                    samples.append(('_sum', (('operation', operation),), histogram[-1]))
+                    samples.append(('_count', (('operation', operation),), sum(histogram[:-1])))
+                metric('%s_latency_seconds' % name, 'histogram', text, samples)
+
+        return '\n'.join(out) + '\n'
+
+    def serve(self, port):
+        """
+        Serves the metrics in Prometheus text format on localhost port.
+        """
+        metrics = self
+
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug('metrics request: ' + format, *args)
+
+        self.httpd = HTTPServer(('127.0.0.1', port), handler)
+        thread = threading.Thread(target=self.httpd.serve_forever, name='ncMetrics-http')
+        thread.daemon = True
+        thread.start()
+        log.info('Serving metrics on http://127.0.0.1:%d/metrics', port)
+
+    def dump(self, filename, interval):
+        """
+        Writes the metrics as JSON to filename every interval seconds.
+        """
+        def dumper():
+            while True:
+                time.sleep(interval)
+                try:
+                    with open(filename + '.tmp', 'w') as file:
+                        json.dump(self.snapshot(), file, indent=2, sort_keys=True)
+                    os.rename(filename + '.tmp', filename)
+                except Exception as e:
+                    log.error('Writing metrics to %s failed: %s', filename, str(e))
+
+        thread = threading.Thread(target=dumper, name='ncMetrics-dump')
+        thread.daemon = True
+        thread.start()
+
+
+class ncSharedCounter(object):
+    """
+    Counter shared by the worker processes, used for session ids.
+    """
+
+    def __init__(self):
+        self.value = multiprocessing.Value('Q', 0)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.value.get_lock():
+            self.value.value += 1
+            return self.value.value
+
+    next = __next__
+
+
+class ncWorkers(object):
+    """
+    Master process of --workers.
+
+    Forks the worker processes, which accept client connections on
+    listening sockets shared using SO_REUSEPORT, and restarts workers that
+    died. On SIGHUP reload() is called and the signal is forwarded to the
+    workers, which reload routes and rules in place. On SIGUSR2 reload() is
+    called and a new generation of workers is started; the previous
+    generation drains: it stops accepting connections and exits once its
+    sessions are finished or the drain timeout expired.
+    The workers send their metrics to the master, which merges them.
+    """
+
+    STARTUP = 5
+
+    def __init__(self, count, metrics, reload=None):
+        self.count = count
+        self.metrics = metrics
+        self.reload = reload
+        self.master = os.getpid()
+        self.workers = {}
+        self.generation = 0
+        self.retired = ncMetrics(True)
+        self.reloading = False
+        self.replacing = False
+        self.stopping = False
+        self.failed = False
+
+    def spawn(self, slot):
+        """
+        Forks a worker. Returns (slot, metrics pipe) in the worker and
+        None in the master.
+        """
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            for worker in self.workers.values():
+                os.close(worker['pipe'])
+            if self.metrics.httpd is not None:
+                self.metrics.httpd.socket.close()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, signal.SIG_DFL)
+            # --- forwarded signals must not kill a worker still starting ----
+            for signum in (signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2):
+                signal.signal(signum, signal.SIG_IGN)
+            return slot, wfd
+
+        os.close(wfd)
+        os.set_blocking(rfd, False)
+        self.workers[pid] = {'slot': slot, 'generation': self.generation, 'started': time.time(),
+                             'pipe': rfd, 'data': b'', 'state': None, 'draining': False}
+        log.info('Worker %d started (pid %d, generation %d)', slot, pid, self.generation)
+        return None
+
+    def run(self):
+        """
+        Runs the master. Returns (slot, metrics pipe) in the workers only.
+        """
+        signal.signal(signal.SIGHUP, lambda signum, frame: setattr(self, 'reloading', True))
+        signal.signal(signal.SIGUSR2, lambda signum, frame: setattr(self, 'replacing', True))
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, 'stopping', True))
+        signal.signal(signal.SIGINT, lambda signum, frame: setattr(self, 'stopping', True))
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.kill(signal.SIGUSR1))
+
+        for slot in range(self.count):
+            child = self.spawn(slot)
+            if child is not None:
+                return child
+
+        while not self.stopping:
+            if self.reloading:
+                self.reloading = False
+                log.info('Reloading routes and rules')
+                if self.reload is not None:
+                    self.reload()
+                self.kill(signal.SIGHUP)
+
+            if self.replacing:
+                self.replacing = False
+                child = self.replace()
+                if child is not None:
+                    return child
+
+            child = self.reap()
+            if child is not None:
+                return child
+
+            self.collect(1.0)
+
+        log.info('ncproxy terminated, stopping workers')
+        self.kill(signal.SIGTERM)
+        while self.workers:
+            pid, status = os.wait()
+            self.workers.pop(pid, None)
+        sys.exit(1 if self.failed else 0)
+
+    def replace(self):
+        """
+        Starts a new generation of workers and lets the previous one drain.
+        """
+        log.info('Starting worker generation %d', self.generation + 1)
+        if self.reload is not None:
+            self.reload()
+        previous = list(self.workers)
+        self.generation += 1
+        for slot in range(self.count):
+            child = self.spawn(slot)
+            if child is not None:
+                return child
+        # --- workers already draining reload their rules as well ------------
+        for pid in previous:
+            self.workers[pid]['draining'] = True
+            self.signal(pid, signal.SIGUSR2)
+        return None
+
+    def reap(self):
+        """
+        Handles terminated workers, restarting them unless draining.
+        Returns (slot, metrics pipe) in a restarted worker.
+        """
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return None
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            self.read(worker)
+            os.close(worker['pipe'])
+            if worker['state'] is not None:
+                worker['state']['sessions'] = []
+                worker['state']['pending'] = []
+                self.retired.add(worker['state'])
+
+            if worker['draining']:
+                log.info('Worker %d drained (pid %d)', worker['slot'], pid)
+                continue
+            log.error('Worker %d died (pid %d, status %d)', worker['slot'], pid, status)
+            if time.time() - worker['started'] < self.STARTUP and status != 0:
+                log.critical('Worker %d failed during startup, exiting', worker['slot'])
+                self.stopping = self.failed = True
+                return None
+            child = self.spawn(worker['slot'])
+            if child is not None:
+                return child
+        return None
+
+    def collect(self, timeout):
+        """
+        Reads the metrics sent by the workers and merges them.
+        """
+        sel = selectors.DefaultSelector()
+        for worker in self.workers.values():
+            sel.register(worker['pipe'], selectors.EVENT_READ, worker)
+        try:
+            events = sel.select(timeout)
+        finally:
+            sel.close()
+        for key, mask in events:
+            self.read(key.data)
+        if self.metrics.enabled and events:
+            states = [worker['state'] for worker in self.workers.values() if worker['state'] is not None]
+            self.metrics.merge([self.retired.state()] + states)
+
+    def read(self, worker):
+        try:
+            while True:
+                data = os.read(worker['pipe'], 1048576)
+                if not data:
+                    break
+                worker['data'] += data
+        except (BlockingIOError, InterruptedError):
+            pass
+        lines = worker['data'].split(b'\n')
+        worker['data'] = lines.pop()
+        if lines:
+            worker['state'] = json.loads(lines[-1].decode('utf-8'))
+
+    def signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+    def kill(self, signum):
+        for pid in list(self.workers):
+            self.signal(pid, signum)
+
+
+class ncSender(object):
+    """
+    Sends the data of one direction of a session from its own thread, so a
+    peer reading slowly does not stall the other direction or the draining
+    of the channel it is fed from.
+
+    Up to maxqueue bytes are queued. Above, full() is True and the relay
+    stops reading the channel feeding the sender, so the SSH window of that
+    channel closes and throttles the peer sending (backpressure). Once the
+    queue drained to half of maxqueue, or sending failed, wake() is called.
+    """
+
+    def __init__(self, channel, session, direction, maxqueue, wake):
+        self.channel = channel
+        self.session = session
+        self.direction = direction
+        self.maxqueue = maxqueue
+        self.wake = wake
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.size = 0
+        self.paused = False
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='ncSender-%d-%s' % (session, direction))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, data):
+        with self.cond:
+            self.queue.append(data)
+            self.size += len(data)
+            self.cond.notify()
+
+    def full(self):
+        """
+        Returns True while the relay must not read from the channel feeding
+        this sender.
+        """
+        with self.cond:
+            if not self.paused and self.size >= self.maxqueue:
+                self.paused = True
+                metrics.pause(self.direction)
+                log.debug('Session %d: %s data queued %d bytes, pausing', self.session, self.direction, self.size)
+            return self.paused
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                data = self.queue[0]
+            try:
+                t0 = time.time()
+                nc_send(self.channel, data)
+                metrics.transfer(self.session, self.direction, len(data), time.time() - t0)
+            except Exception as e:
+                with self.cond:
+                    self.error = e
+                    self.queue.clear()
+                    self.size = 0
+                    self.cond.notify_all()
+                self.wake()
+                return
+            with self.cond:
+                if self.queue and self.queue[0] is data:
+                    self.queue.popleft()
+                    self.size -= len(data)
+                resume = self.paused and self.size <= self.maxqueue // 2
+                if resume:
+                    self.paused = False
+                if not self.queue:
+                    self.cond.notify_all()
+            if resume:
+                self.wake()
+
+    def close(self, active=lambda: True):
+        """
+        Sends the queued data, while active() is True, and stops the thread.
+        """
+        with self.cond:
+            while self.queue and self.error is None and active():
+                self.cond.wait(1.0)
+            self.closed = True
+            self.queue.clear()
+            self.size = 0
+            self.cond.notify_all()
+
+
 class ncHandler(paramiko.SubsystemHandler):
 
+    sessionids = itertools.count(1)
+    PEEKSIZE = 4096
+
     def __init__(self, channel, name, server, srv_transport):
         paramiko.SubsystemHandler.__init__(self, channel, name, server)
         self.srv_transport = srv_transport
 
     def start_subsystem(self, name, transport, channel):
+        if replay is not None:
+            self.replay_subsystem(transport, channel)
+            return
+
+        server = self.get_server()
         try:
-            srv_channel = self.srv_transport.open_session()
-            srv_channel.invoke_subsystem('netconf')
+            try:
+                srv_channel = self.srv_transport.open_session()
+                srv_channel.invoke_subsystem('netconf')
+            except Exception as e:
+                if not server.srv_reused:
+                    raise
+                # --- pooled transport went stale, connect again -------------
+                log.info('Pooled transport to %s failed: %s', server.target['name'], str(e))
+                pool.release(self.srv_transport, discard=True)
+                self.srv_transport = None
+                self.srv_transport, server.srv_reused = pool.acquire(server.srv_poolkey, server.srv_connect)
+                srv_channel = self.srv_transport.open_session()
+                srv_channel.invoke_subsystem('netconf')
 
         except Exception as e:
             # --- close channel/transport to NETCONF client ------------------
-            log.warning('NETCONF over SSH to %s failed: %s', url.hostname, str(e))
+            log.warning('NETCONF over SSH to %s failed: %s', server.target['name'], str(e))
+            if self.srv_transport is not None:
+                pool.release(self.srv_transport, discard=True)
             channel.close()
             transport.close()
             return
 
-        log.info('NETCONF messaging capture')
+        self.session = next(ncHandler.sessionids)
+        log.info('NETCONF messaging capture (session %d)', self.session)
+
+        self.channel = channel
+        self.srv_channel = srv_channel
+        self.srvframer = ncFramer(options.maxbuffer, peeksize=self.PEEKSIZE)
+        self.nccframer = ncFramer(options.maxbuffer, peeksize=self.PEEKSIZE)
+
+        # --- stream messages no rule selects, if complete ones not needed ---
+        if not (capture.indexed or cache.enabled):
+            self.srvframer.stream = self.stream_server
+            if not (scheduler.enabled or fanout.enabled):
+                self.nccframer.stream = self.stream_client
+
+        # --- messages are only deframed if a rule may apply -----------------
+        self.srvrules = self.nccrules = None
+        self.srvpassthrough = self.nccpassthrough = True
+        self.update_rules()
+        if self.srvpassthrough and self.nccpassthrough:
+            log.debug('No rules defined, passthrough mode')
+
+        # --- response cache state -------------------------------------------
+        self.device = server.srv_poolkey[:2]
+        self.username = server.srv_poolkey[2]
+        self.outstanding = set()            # message-ids of rpcs forwarded
+        self.leading = {}                   # message-id -> cache flight
+        self.writes = set()                 # message-ids of invalidating rpcs
+        self.waiting = collections.deque()  # rpcs waiting for other sessions or the scheduler
+        self.deferred = collections.deque() # client messages queued behind them
+        self.scheduled = collections.Counter()  # message-ids of rpcs admitted
+        self.subscriptions = []             # shared notification subscriptions
+        self.poolkey = server.srv_poolkey
+        self.connect = server.srv_connect
 
-        nccbuf = ""
-        srvbuf = ""
+        # --- each direction is sent by its own thread -----------------------
+        self.wakeup = socket.socketpair()
+        self.wakeup[0].setblocking(False)
+        self.wakeup[1].setblocking(False)
+        self.toclient = ncSender(channel, self.session, 'server', options.relayqueue, self.wake)
+        self.toserver = ncSender(srv_channel, self.session, 'client', options.relayqueue, self.wake)
 
+        try:
+            if options.relay == 'poll':
+                self.relay_poll(transport)
+            else:
+                self.relay_select(transport)
+        finally:
+            for flight in self.leading.values():
+                cache.abandon(flight)
+            for job in self.waiting:
+                if 'queued' in job:
+                    scheduler.cancel(self.device, job)
+            if self.scheduled:
+                scheduler.release(self.device, sum(self.scheduled.values()))
+            for subscriber in self.subscriptions:
+                fanout.unsubscribe(subscriber)
+            self.toserver.close(self.srv_transport.is_active)
+            self.toclient.close(transport.is_active)
+            self.wakeup[0].close()
+            self.wakeup[1].close()
+
+        if srv_channel.exit_status_ready() or srv_channel.eof_received:
+            log.warning("Connection closed by peer; server down")
+        if channel.exit_status_ready() or channel.eof_received:
+            log.warning("Connection closed by peer; client down")
+
+        # --- close channel/transport to NETCONF server ----------------------
+        srv_channel.close()
+        pool.release(self.srv_transport)
+        capture.close(self.session)
+        metrics.close(self.session)
+
+    def relay_poll(self, transport):
+        """
+        Legacy relay engine: polls both channels every 10ms. Kept for
+        comparison with the event-driven engine (--relay poll).
+        """
         while transport.is_active():
-            # --- receive bytes from server, append to srvbuf ----------------
+            if not self.toclient.full():
+                self.server_input()
+            if not self.client_paused():
+                self.client_input()
+            self.resume()
 
-            while srv_channel.recv_ready():
-                srvbuf += srv_channel.recv(65535)
+            if self.toclient.error is not None or self.toserver.error is not None or self.detached():
+                break
+            if self.srv_channel.exit_status_ready():
+                break
+            if self.channel.exit_status_ready():
+                break
+            time.sleep(0.01)
 
-            # --- extract srvmsgs[] from srvbuf ------------------------------
+        else:
+            log.info('NETCONF communication finished')
 
-            srvmsgs = []
-            if len(srvbuf) > 4:
-                if srvbuf[0:2] != "\n#":
-                    base10 = True   # --- base:1.0 framing (EOM) -------------
-                    srvmsgs = srvbuf.split("]]>]]>")
-                    srvbuf = srvmsgs.pop()
-                else:
-                    base10 = False  # --- base:1.1 framing (chunks) ----------
-
-                    tmp = ""
-                    pos = 0
-
-                    while pos < len(srvbuf) and len(srvbuf) > 4:
-                        if srvbuf[pos:pos + 4] == "\n##\n":
-                            srvmsgs.append(tmp)
-                            tmp = ""
-                            srvbuf = srvbuf[pos + 4:]
-                            pos = 0
-                        elif srvbuf[pos:pos + 2] == "\n#":
-                            idx = srvbuf.find("\n", pos + 2)
-                            if idx != -1:
-                                bytes = int(srvbuf[pos + 2:idx])
-                                tmp += srvbuf[idx + 1:idx + 1 + bytes]
-                                pos = idx + 1 + bytes
-                            else:
-                                # --- need to wait for more bytes to come ----
-                                break
-                        else:
-                            log.error('SERVER FRAMING ERROR')
-                            srvbuf = ""
-                            break
-
-            # --- patch, forward, print NETCONF server messages: srvmsgs[] ---
-            for msg in srvmsgs:
-                for rule in rules['server-msg-modifier']:
-                    msg = rule['regex'].sub(rule['patch'], msg)
-
-                if not base10:
-                    buf = "\n#%d\n" % len(msg)
-                    channel.send(buf)
-                    serverlog.write(buf)
-
-                pos = 0
-                while pos < len(msg):
-                    if pos + 16384 < len(msg):
-                        buf = msg[pos:pos + 16384]
-                        pos += 16384
-                    else:
-                        buf = msg[pos:]
-                        pos = len(msg)
-                    channel.send(buf)
-                    serverlog.write(buf)
-
-                if base10:
-                    buf = "]]>]]>"
+    def relay_select(self, transport):
+        """
+        Event-driven relay engine: sleeps until one of the channels becomes
+        readable, so messages are forwarded as soon as they arrive and idle
+        sessions do not consume any CPU. A channel is not read while the
+        data read from it can not be sent (see ncSender and client_paused).
+        """
+        sel = selectors.DefaultSelector()
+        sel.register(self.wakeup[0], selectors.EVENT_READ, self.resume)
+        inputs = ((self.srv_channel, self.server_input, self.toclient.full),
+                  (self.channel, self.client_input, self.client_paused))
+        reading = set()
+
+        try:
+            while transport.is_active():
+                for channel, handler, full in inputs:
+                    paused = full()
+                    if paused and channel in reading:
+                        sel.unregister(channel)
+                        reading.discard(channel)
+                    elif not paused and channel not in reading:
+                        sel.register(channel, selectors.EVENT_READ, handler)
+                        reading.add(channel)
+
+                for key, mask in sel.select(timeout=1.0):
+                    key.data()
+
+                if self.toclient.error is not None or self.toserver.error is not None or self.detached():
+                    break
+                if self.srv_channel.exit_status_ready() or self.srv_channel.eof_received and not self.srv_channel.recv_ready():
+                    break
+                if self.channel.exit_status_ready() or self.channel.eof_received and not self.channel.recv_ready():
+                    break
+                if self.srv_channel.closed or self.channel.closed:
+                    break
+
+            else:
+                log.info('NETCONF communication finished')
+        finally:
+            sel.close()
+
+    def client_paused(self):
+        """
+        Returns True while client messages can not be forwarded: the data
+        sent to the server is backed up, or rpcs of the session wait for the
+        scheduler or for the reply of another session. The client is then
+        throttled by the SSH window, instead of its messages being queued.
+        """
+        return self.toserver.full() or bool(self.waiting)
+
+    def update_rules(self):
+        """
+        Picks up a new version of the patch rules. A deframing direction
+        switches at the next message if the new rules need deframing as well;
+        otherwise the switch waits until no partial message is pending, as
+        only then the framer knows where the next message starts. Framers of
+        passthrough directions keep only the head of every message, unless
+        the indexed capture needs them complete.
+        """
+        current = rules.current
+        deframe = bool(current['server-msg-modifier']) or cache.enabled
+        if self.srvrules is not current and (self.srvframer.idle() or deframe and not self.srvpassthrough):
+            if self.srvrules is not None:
+                log.info('Session %d: server messages use patch rules version %d', self.session, current.version)
+            self.srvrules = current
+            self.srvpassthrough = not deframe
+            self.srvframer.headsize = self.PEEKSIZE if self.srvpassthrough and not capture.indexed else None
+        deframe = bool(current['client-msg-modifier'] or current['auto-respond']) or cache.enabled or scheduler.enabled or fanout.enabled
+        if self.nccrules is not current and (self.nccframer.idle() or deframe and not self.nccpassthrough):
+            if self.nccrules is not None:
+                log.info('Session %d: client messages use patch rules version %d', self.session, current.version)
+            self.nccrules = current
+            self.nccpassthrough = not deframe
+            self.nccframer.headsize = self.PEEKSIZE if self.nccpassthrough and not capture.indexed else None
+
+    def stream_server(self, head):
+        """
+        Returns True if no rule selects the server message starting with
+        head, so it is forwarded as received without waiting for its end.
+        """
+        if self.srvrules is not rules.current:
+            self.update_rules()
+        return not self.srvrules.select('server-msg-modifier', head)
+
+    def stream_client(self, head):
+        """
+        Returns True if no rule selects the client message starting with
+        head, so it is forwarded as received without waiting for its end.
+        """
+        if self.nccrules is not rules.current:
+            self.update_rules()
+        return not (self.nccrules.select('client-msg-modifier', head) or self.nccrules.select('auto-respond', head))
+
+    def stream(self, direction, framer, sender):
+        """
+        Sends and captures the bytes of a streamed message received so far.
+        """
+        buf = framer.flush()
+        if buf:
+            sender.send(buf)
+            capture.write(self.session, direction, buf)
+
+    def server_input(self):
+        channel = self.channel
+        srv_channel = self.srv_channel
+        framer = self.srvframer
+
+        if self.srvrules is not rules.current:
+            self.update_rules()
+
+        # --- passthrough: no rule can apply, forward bytes as received -----
+        if self.srvpassthrough:
+            while srv_channel.recv_ready() and not self.toclient.full():
+                buf = srv_channel.recv(65535)
+                received = time.time()
+                self.toclient.send(buf)
+                self.passthrough_capture('server', framer, buf, received)
+            while srv_channel.recv_stderr_ready():
+                log.warning('NETCONF server stderr: %s', srv_channel.recv_stderr(65535))
+            if self.subscriptions:
+                self.notify()
+            return
+
+        # --- receive bytes from server --------------------------------------
+        while srv_channel.recv_ready() and not self.toclient.full():
+            framer.feed(srv_channel.recv(65535))
+        while srv_channel.recv_stderr_ready():
+            log.warning('NETCONF server stderr: %s', srv_channel.recv_stderr(65535))
+
+        # --- patch, forward, print NETCONF server messages ------------------
+        try:
+            for msg in framer:
+                received = time.time()
+                self.stream('server', framer, self.toclient)
+                if framer.framed() is None:
+                    metrics.message(self.session, 'server', msg, received, received, time.time())
+                    if self.scheduled:
+                        self.release(msg)
+                    continue
+                if self.srvrules is not rules.current:
+                    self.update_rules()
+                msg, patched = self.srvrules.patch('server-msg-modifier', msg)
+
+                # --- unmodified messages are forwarded as received ----------
+                if patched:
+                    buf = framer.frame(msg)
                 else:
-                    buf = "\n##\n"
-                channel.send(buf)
-                serverlog.write(buf)
-                serverlog.flush()
+                    buf = framer.framed()
+                forwarding = time.time()
+                self.toclient.send(buf)
+                forwarded = time.time()
+                capture.message(self.session, 'server', buf, msg)
+                metrics.message(self.session, 'server', msg, received, forwarding, forwarded)
+                if cache.enabled:
+                    self.cache_reply(msg)
+                if self.scheduled:
+                    self.release(msg)
+            self.stream('server', framer, self.toclient)
+
+        except ncFramingError as e:
+            metrics.error('server')
+            log.error('SERVER FRAMING ERROR: %s', str(e))
+
+        if self.subscriptions:
+            self.notify()
+
+    def client_input(self):
+        channel = self.channel
+        srv_channel = self.srv_channel
+        framer = self.nccframer
 
-            # --- receive bytes from client, append to nccbuf ----------------
+        if self.nccrules is not rules.current:
+            self.update_rules()
 
-            while channel.recv_ready():
-                nccbuf += channel.recv(65535)
+        # --- passthrough: no rule can apply, forward bytes as received -----
+        if self.nccpassthrough:
+            while channel.recv_ready() and not self.toserver.full():
+                buf = channel.recv(65535)
+                received = time.time()
+                self.toserver.send(buf)
+                self.passthrough_capture('client', framer, buf, received)
+            return
+
+        # --- receive bytes from client --------------------------------------
+        while channel.recv_ready() and not self.toserver.full():
+            framer.feed(channel.recv(65535))
 
-            # --- extract nccmsgs[] from nccbuf ------------------------------
+        # --- patch, forward, print NETCONF client messages ------------------
+        try:
+            for msg in framer:
+                received = time.time()
+                self.stream('client', framer, self.toserver)
+                if framer.framed() is None:
+                    metrics.message(self.session, 'client', msg, received, received, time.time())
+                    continue
+                if self.nccrules is not rules.current:
+                    self.update_rules()
+                msg, patched = self.nccrules.patch('client-msg-modifier', msg)
 
-            nccmsgs = []
-            if len(nccbuf) > 4:
-                if nccbuf[0:2] != "\n#":
-                    base10 = True   # --- base:1.0 framing (EOM) -------------
-                    nccmsgs = nccbuf.split("]]>]]>")
-                    nccbuf = nccmsgs.pop()
+                # --- unmodified messages are forwarded as received ----------
+                if patched:
+                    buf = framer.frame(msg)
                 else:
-                    base10 = False  # --- base:1.1 framing (chunks) ----------
-
-                    tmp = ""
-                    pos = 0
-
-                    while pos < len(nccbuf) and len(nccbuf) > 4:
-                        if nccbuf[pos:pos + 4] == "\n##\n":
-                            nccmsgs.append(tmp)
-                            tmp = ""
-                            nccbuf = nccbuf[pos + 4:]
-                            pos = 0
-                        elif nccbuf[pos:pos + 2] == "\n#":
-                            idx = nccbuf.find("\n", pos + 2)
-                            if idx != -1:
-                                bytes = int(nccbuf[pos + 2:idx])
-                                tmp += nccbuf[idx + 1:idx + 1 + bytes]
-                                pos = idx + 1 + bytes
-                            else:
-                                # --- need to wait for more bytes to come ----
-                                break
-                        else:
-                            log.error('CLIENT FRAMING ERROR')
-                            nccbuf = ""
-                            break
-
-            # --- patch, forward, print NETCONF client messages: nccmsgs[] ---
-            for msg in nccmsgs:
-                for rule in rules['client-msg-modifier']:
-                    msg = rule['regex'].sub(rule['patch'], msg)
-
-                sendmsg = True
-                for rule in rules['auto-respond']:
-                    if rule['regex'].match(msg):
-                        log.info('Auto-response to NETCONF client message')
-                        tmp = rule['regex'].sub(rule['response'], msg)
-                        if base10:
-                            srvbuf += tmp
-                            srvbuf += "]]>]]>"
-                        else:
-                            srvbuf += "\n#%d\n" % len(tmp)
-                            srvbuf += tmp
-                            srvbuf += "\n##\n"
-                        sendmsg = False
-                        break
+                    buf = framer.framed()
+                capture.message(self.session, 'client', buf, msg)
 
-                if not base10:
-                    buf = "\n#%d\n" % len(msg)
-                    if sendmsg:
-                        srv_channel.send(buf)
-                    clientlog.write(buf)
-
-                pos = 0
-                while pos < len(msg):
-                    if pos + 16384 < len(msg):
-                        buf = msg[pos:pos + 16384]
-                        pos += 16384
-                    else:
-                        buf = msg[pos:]
-                        pos = len(msg)
-                    if sendmsg:
-                        srv_channel.send(buf)
-                    clientlog.write(buf)
-
-                if base10:
-                    buf = "]]>]]>"
+                # --- replies must be sent in order of the requests ----------
+                if self.waiting:
+                    self.deferred.append((msg, buf, received))
                 else:
-                    buf = "\n##\n"
-                if sendmsg:
-                    srv_channel.send(buf)
-                clientlog.write(buf)
-                clientlog.flush()
+                    self.client_message(msg, buf, received)
+            self.stream('client', framer, self.toserver)
 
-            if srv_channel.exit_status_ready():
-                break
-            if channel.exit_status_ready():
-                break
-            time.sleep(0.01)
+        except ncFramingError as e:
+            metrics.error('client')
+            log.error('CLIENT FRAMING ERROR: %s', str(e))
 
+    def client_message(self, msg, buf, received):
+        """
+        Answers a client message by auto-response, from a shared subscription
+        or from the response cache, or forwards it to the server.
+        """
+        response = self.nccrules.respond(msg)
+        waiting = False
+        if response is not None:
+            log.info('Auto-response to NETCONF client message')
+        elif fanout.enabled:
+            response, waiting = self.subscribe(msg, buf, received)
+        if response is None and not waiting and cache.enabled:
+            response, waiting = self.cache_request(msg, buf, received)
+        if waiting:
+            return
+        forwarding = time.time()
+        if response is not None:
+            self.answer(msg, response, received, forwarding)
         else:
-            serverlog.flush()
-            clientlog.flush()
-            log.info('NETCONF communication finished')
+            self.forward(msg, buf, received, forwarding)
 
-        if srv_channel.exit_status_ready():
-            log.warning("Connection closed by peer; server down")
-        if channel.exit_status_ready():
-            log.warning("Connection closed by peer; client down")
+    def forward(self, msg, buf, received, forwarding):
+        """
+        Sends a client message to the server, rpcs once admitted by the
+        scheduler.
+        """
+        if scheduler.enabled:
+            msgtype, msgid, operation = nc_peek(msg)
+            if msgtype == 'rpc' and msgid is not None:
+                job = {'msgid': msgid, 'operation': operation, 'msg': msg, 'buf': buf, 'received': received,
+                       'forwarding': forwarding, 'reply': None, 'done': False, 'wake': self.wake}
+                if not scheduler.submit(self.device, job):
+                    # --- no message of the session may overtake the rpc -----
+                    self.waiting.appendleft(job)
+                    return
+                self.scheduled[msgid] += 1
+        self.toserver.send(buf)
+        forwarded = time.time()
+        metrics.message(self.session, 'client', msg, received, forwarding, forwarded)
 
-        # --- close channel/transport to NETCONF server ----------------------
-        srv_channel.close()
-        self.srv_transport.close()
+    def answer(self, msg, response, received, forwarding):
+        """
+        Sends response to client message msg on behalf of the server.
+        """
+        metrics.message(self.session, 'client', msg, received, forwarding)
+        buf = self.nccframer.frame(response)
+        self.toclient.send(buf)
+        forwarded = time.time()
+        capture.message(self.session, 'server', buf, response)
+        metrics.message(self.session, 'server', response, None, None, forwarded)
+
+    def cache_request(self, msg, buf, received):
+        """
+        Looks up a client rpc in the response cache. Returns the cached reply
+        or None, and whether the rpc waits for the reply of another session.
+        Cached replies are only used while no rpc of this session is
+        outstanding, as they would overtake its reply.
+        """
+        msgtype, msgid, operation = nc_peek(msg)
+        if msgtype != 'rpc' or msgid is None:
+            return None, False
+        if operation in cache.INVALIDATE:
+            cache.invalidate(self.device)
+            self.writes.add(msgid)
+        elif operation in cache.operations and self.outstanding:
+            cache.bypass()
+        elif operation in cache.operations:
+            waiter = {'msgid': msgid, 'msg': msg, 'buf': buf, 'received': received,
+                      'reply': None, 'done': False, 'wake': self.wake}
+            reply, flight = cache.get(cache.key(self.device, self.username, msg), waiter)
+            if reply is not None:
+                return nc_messageid(reply, msgid), False
+            if flight is None:
+                self.waiting.append(waiter)
+                return None, True
+            self.leading[msgid] = flight
+        self.outstanding.add(msgid)
+        return None, False
+
+    def cache_reply(self, msg):
+        """
+        Passes server replies to rpcs this session forwarded for the cache.
+        """
+        msgtype, msgid, operation = nc_peek(msg)
+        if msgtype != 'rpc-reply' or msgid not in self.outstanding:
+            return
+        self.outstanding.discard(msgid)
+        flight = self.leading.pop(msgid, None)
+        if flight is not None:
+            cache.complete(flight, msg)
+        if msgid in self.writes:
+            self.writes.discard(msgid)
+            cache.invalidate(self.device)
+
+    def release(self, msg):
+        """
+        Frees the scheduler slot of the rpc a server reply answers.
+        """
+        msgtype, msgid, operation = nc_peek(msg)
+        if msgtype != 'rpc-reply' or not self.scheduled[msgid]:
+            return
+        self.scheduled[msgid] -= 1
+        if not self.scheduled[msgid]:
+            del self.scheduled[msgid]
+        scheduler.release(self.device)
+
+    def subscribe(self, msg, buf, received):
+        """
+        Subscribes the session to a shared notification subscription.
+        Returns the reply to a create-subscription rpc or None, and whether
+        the rpc waits for the subscription session to be established.
+        """
+        key = fanout.key(self.device, self.username, msg)
+        if key is None:
+            return None, False
+        subscriber = {'name': 'session %d' % self.session, 'msgid': nc_peek(msg)[1], 'msg': msg, 'buf': buf,
+                      'received': received, 'reply': None, 'done': False, 'wake': self.wake,
+                      'queue': collections.deque(), 'size': 0, 'active': False, 'closed': False}
+        self.subscriptions.append(subscriber)
+        reply = fanout.subscribe(key, subscriber, self.poolkey, self.connect)
+        if reply is None:
+            self.waiting.append(subscriber)
+            return None, True
+        subscriber['active'] = True
+        return nc_messageid(reply, subscriber['msgid']), False
+
+    def notify(self):
+        """
+        Sends the notifications of the shared subscriptions queued for the
+        session, after the reply to its create-subscription rpc. While part
+        of a server message was forwarded as received, notifications stay
+        queued until its end.
+        """
+        if self.srvframer.streaming or self.srvpassthrough and not self.srvframer.idle():
+            return
+        for subscriber in self.subscriptions:
+            while subscriber['active'] and not self.toclient.full():
+                msg = fanout.pop(subscriber)
+                if msg is None:
+                    break
+                buf = self.nccframer.frame(msg)
+                self.toclient.send(buf)
+                forwarded = time.time()
+                capture.message(self.session, 'server', buf, msg)
+                metrics.message(self.session, 'server', msg, None, None, forwarded)
+
+    def detached(self):
+        """
+        Returns True if a shared subscription of the session ended, as the
+        server closed it or the session did not keep up with it.
+        """
+        return any(subscriber['closed'] for subscriber in self.subscriptions)
+
+    def wake(self):
+        try:
+            self.wakeup[1].send(b'\0')
+        except socket.error:
+            pass
+
+    def resume(self):
+        """
+        Called when woken up by another thread: answers coalesced rpcs and
+        subscriptions whose reply arrived and forwards rpcs the scheduler
+        admitted, then handles the client messages queued behind them and
+        sends queued notifications.
+        """
+        try:
+            while self.wakeup[0].recv(4096):
+                pass
+        except socket.error:
+            pass
+        while self.waiting and self.waiting[0]['done']:
+            waiter = self.waiting.popleft()
+            forwarding = time.time()
+            if waiter['reply'] is not None:
+                self.answer(waiter['msg'], nc_messageid(waiter['reply'], waiter['msgid']), waiter['received'], forwarding)
+                waiter['active'] = True
+                continue
+            if 'queued' in waiter:
+                # --- admitted by the scheduler ------------------------------
+                self.scheduled[waiter['msgid']] += 1
+                self.toserver.send(waiter['buf'])
+                forwarded = time.time()
+                metrics.message(self.session, 'client', waiter['msg'], waiter['received'], waiter['forwarding'], forwarded)
+                continue
+            # --- the other session went away, forward the rpc ---------------
+            self.outstanding.add(waiter['msgid'])
+            self.forward(waiter['msg'], waiter['buf'], waiter['received'], forwarding)
+        while self.deferred and not self.waiting:
+            self.client_message(*self.deferred.popleft())
+        if self.subscriptions:
+            self.notify()
+
+    def replay_subsystem(self, transport, channel):
+        """
+        Replay mode: answers the client from the recorded responses, without
+        any NETCONF server.
+        """
+        self.session = next(ncHandler.sessionids)
+        log.info('NETCONF replay (session %d)', self.session)
+
+        framer = ncFramer()
+        hello = re.sub(rb'<session-id>\d+</session-id>', b'<session-id>%d</session-id>' % self.session, replay.hello)
+        buf = framer.frame(hello, base10=True)
+        nc_send(channel, buf)
+        capture.message(self.session, 'server', buf, hello)
+        metrics.message(self.session, 'server', hello)
+
+        try:
+            while transport.is_active():
+                data = channel.recv(65535)
+                if not data:
+                    break
+                framer.feed(data)
+
+                for msg in framer:
+                    received = time.time()
+                    capture.message(self.session, 'client', framer.framed(), msg)
+                    metrics.message(self.session, 'client', msg, received)
+                    msgtype, msgid, operation = nc_peek(msg)
+                    if msgtype != 'rpc':
+                        continue
+
+                    response = rules.current.respond(msg)
+                    if response is None:
+                        response = replay.lookup(msg)
+                    if response is None and operation == 'close-session':
+                        response = nc_messageid(replay.CLOSE, msgid)
+                    if response is None:
+                        log.info('Replay: no recorded response for %s (message-id %s)', operation, msgid)
+                        response = nc_messageid(replay.ERROR, msgid)
+
+                    buf = framer.frame(response)
+                    forwarding = time.time()
+                    nc_send(channel, buf)
+                    forwarded = time.time()
+                    capture.message(self.session, 'server', buf, response)
+                    metrics.transfer(self.session, 'server', len(buf), forwarded - forwarding)
+                    metrics.message(self.session, 'server', response, None, None, forwarded)
+
+                    if operation == 'close-session':
+                        raise EOFError
+
+        except EOFError:
+            pass
+        except ncFramingError as e:
+            metrics.error('client')
+            log.error('CLIENT FRAMING ERROR: %s', str(e))
+        except Exception as e:
+            log.warning('NETCONF replay failed: %s', str(e))
+
+        log.info('NETCONF communication finished')
+        channel.close()
+        capture.close(self.session)
+        metrics.close(self.session)
+
+    def passthrough_capture(self, direction, framer, buf, received):
+        """
+        Captures bytes forwarded in passthrough mode. The indexed capture
+        format needs complete messages, so these are deframed on the side.
+        For the metrics, the scheduler, and to know the message boundaries
+        for switching to a new rule version or inserting notifications, the
+        framer only keeps the head of every message (see update_rules()).
+        """
+        forwarded = time.time()
+        if not capture.indexed:
+            capture.write(self.session, direction, buf)
+            if not (metrics.enabled or rules.filename is not None or scheduler.enabled or fanout.enabled):
+                return
+        framer.feed(buf)
+        try:
+            for msg in framer:
+                if capture.indexed:
+                    capture.message(self.session, direction, framer.framed(), msg)
+                metrics.message(self.session, direction, msg, received, received, forwarded)
+                if self.scheduled and direction == 'server':
+                    self.release(msg)
+        except ncFramingError as e:
+            metrics.error(direction)
+            log.error('%s FRAMING ERROR: %s', direction.upper(), str(e))
 
 
 class ssh_server(paramiko.ServerInterface):
 
-    def __init__(self):
-        log.debug("ssh_server.__init__()")
+    def __init__(self, port=None):
+        log.debug("ssh_server.__init__(port=%s)", port)
         self.event = threading.Event()
+        self.authenticated = threading.Event()
+        self.port = port
+        self.target = None
+        self.srv_transport = None
+        self.srv_reused = False
 
     def check_channel_request(self, kind, chanid):
         log.debug("ssh_server.check_channel_request(kind=%s, chanid=%s)",  kind, chanid)
@@ -274,33 +3661,54 @@ class ssh_server(paramiko.ServerInterface):
 
     def check_auth_password(self, username, password):
         log.debug("ssh_server.check_auth_password(username=%s, password=%s)", username, password)
-        try:
-            self.srv_tcpsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.srv_tcpsock.connect((url.hostname, url.port or 830))
-            self.srv_transport = paramiko.Transport(self.srv_tcpsock)
-            self.srv_transport.connect(hostkey=server_host_key, pkey=client_private_key,username=username, password=password)
+        credential = pool.fingerprint('password', password)
+        return self.connect_server(username, credential, password=password)
 
-        except Exception as e:
-            # Should be either of the following:
-            #   paramiko.BadHostKeyException
-            #   paramiko.AuthenticationException
-            #   paramiko.SSHException
-            #   socket.error
-            log.critical('Server session setup/authentication failed: %s', str(e))
-            log.debug(''.join(traceback.format_exception(*sys.exc_info())))
-            self.srv_transport.close()
-            self.srv_tcpsock.close()
+    def check_auth_publickey(self, username, key):
+        log.debug("ssh_server.check_auth_publickey()")
+        credential = pool.fingerprint('publickey', key.get_fingerprint(), client_private_key and client_private_key.get_fingerprint())
+        return self.connect_server(username, credential)
+
+    def connect_server(self, username, credential, password=None):
+        if replay is not None:
+            self.authenticated.set()
+            return paramiko.AUTH_SUCCESSFUL
+
+        # --- select NETCONF server ------------------------------------------
+        routes.check()
+        target, srv_username = routes.lookup(self.port, username)
+        if target is None:
+            log.critical('No route for username %s (port %s)', username, self.port)
             return paramiko.AUTH_FAILED
+        self.target = target
+        username = srv_username
+        log.debug('Session routed to %s as %s', target['name'], username)
 
-        return paramiko.AUTH_SUCCESSFUL
+        def connect():
+            srv_tcpsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                srv_tcpsock.connect((target['hostname'], target['port']))
+                srv_transport = paramiko.Transport(srv_tcpsock, default_window_size=options.serverwindow,
+                                                   default_max_packet_size=options.serverpacket)
+            except Exception:
+                srv_tcpsock.close()
+                raise
+            try:
+                srv_transport.connect(hostkey=target['hostkey'], pkey=client_private_key, username=username, password=password)
+            except Exception:
+                srv_transport.close()
+                raise
+            return srv_transport
+
+        # --- authentication may be attempted more than once -----------------
+        if self.srv_transport is not None:
+            pool.release(self.srv_transport)
+            self.srv_transport = None
 
-    def check_auth_publickey(self, username, key):
-        log.debug("ssh_server.check_auth_publickey()")
         try:
-            self.srv_tcpsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.srv_tcpsock.connect((url.hostname, url.port or 830))
-            self.srv_transport = paramiko.Transport(self.srv_tcpsock)
-            self.srv_transport.connect(hostkey=server_host_key, pkey=client_private_key,username=username)
+            self.srv_poolkey = (target['hostname'], target['port'], username, credential)
+            self.srv_connect = connect
+            self.srv_transport, self.srv_reused = pool.acquire(self.srv_poolkey, connect)
 
         except Exception as e:
             # Should be either of the following:
@@ -310,12 +3718,22 @@ class ssh_server(paramiko.ServerInterface):
             #   socket.error
             log.critical('Server session setup/authentication failed: %s', str(e))
             log.debug(''.join(traceback.format_exception(*sys.exc_info())))
-            self.srv_transport.close()
-            self.srv_tcpsock.close()
             return paramiko.AUTH_FAILED
 
+        self.authenticated.set()
         return paramiko.AUTH_SUCCESSFUL
 
+    def closed(self, transport):
+        """
+        Waits for the client transport to close and returns a server transport
+        no handler has taken over to the pool.
+        """
+        transport.join()
+        if self.srv_transport is not None:
+            log.debug('Client closed before opening a NETCONF session, releasing transport to %s', self.target['name'])
+            pool.release(self.srv_transport)
+            self.srv_transport = None
+
     def get_allowed_auths(self, username):
         log.debug("ssh_server.get_allowed_auths(username=%s)", username)
         return 'publickey,password'
@@ -339,7 +3757,12 @@ class ssh_server(paramiko.ServerInterface):
     def check_channel_subsystem_request(self, channel, name):
         log.debug("ssh_server.check_channel_subsystem_request(name=%s)", name)
         if name == 'netconf':
-            handler = ncHandler(channel, name, self, self.srv_transport)
+            # --- the handler takes over the server transport ----------------
+            srv_transport, self.srv_transport = self.srv_transport, None
+            if srv_transport is None and replay is None:
+                log.critical('Only one NETCONF session per SSH connection is supported')
+                return False
+            handler = ncHandler(channel, name, self, srv_transport)
             handler.start()
             return True
         log.critical('Subsystem %s is NOT supported', name)
@@ -360,7 +3783,23 @@ if __name__ == '__main__':
     group.add_argument('--clientlog', metavar='filename', default='-', type=argparse.FileType('wb', 0), help='client log (default: <stdout>)')
 
     group = parser.add_argument_group()
-    group.add_argument('--patch', metavar='filename', type=argparse.FileType('r'), help='Patch NETCONF messages (default: <none>)')
+    group.add_argument('--capturedir', metavar='directory', help='write capture files to directory instead of server/client log (default: <none>)')
+    group.add_argument('--capturesplit', choices=ncCapture.SPLITS, default='direction', help='capture files per direction, session or both (default: <direction>)')
+    group.add_argument('--rotatesize', metavar='bytes', type=nc_size, default=0, help='rotate capture files at size (default: <none>)')
+    group.add_argument('--rotatetime', metavar='seconds', type=int, default=0, help='rotate capture files after seconds (default: <none>)')
+    group.add_argument('--compress', choices=ncCapture.COMPRESS, default='none', help='compress capture files (default: <none>)')
+    group.add_argument('--capturequeue', metavar='bytes', type=nc_size, default=64 * 1024 * 1024, help='capture queue size (default: <64M>)')
+    group.add_argument('--capturedrop', action='store_true', help='drop capture data if the queue is full instead of waiting')
+    group.add_argument('--captureformat', choices=ncCapture.FORMATS, default='text', help='framed text or indexed message records (default: <text>)')
+
+    group = parser.add_argument_group()
+    group.add_argument('--metricsport', metavar='tcpport', type=int, help='serve Prometheus metrics on localhost port (default: <none>)')
+    group.add_argument('--metricsfile', metavar='filename', help='write metrics as JSON to file (default: <none>)')
+    group.add_argument('--metricsinterval', metavar='seconds', type=int, default=60, help='metrics file update interval (default: <60>)')
+
+    group = parser.add_argument_group()
+    group.add_argument('--patch', metavar='filename', help='Patch NETCONF messages, JSON or YAML rules (default: <none>)')
+    group.add_argument('--maxbuffer', metavar='bytes', type=nc_size, default=16 * 1024 * 1024, help='spool larger messages to temporary files (default: <16M>)')
 
     group = parser.add_argument_group()
     group.add_argument("--clientprivatekey", metavar='filename', type=argparse.FileType('r'), help='client RSA private key file (default: <none>)')
@@ -368,10 +3807,51 @@ if __name__ == '__main__':
     group.add_argument('--proxyhostkeyalg', metavar='RSA ECDSA', default="RSA", type=str, help='proxy host key algorithm (default: <RSA>)')
     group.add_argument("--serverhostkey", metavar='filename', type=argparse.FileType('r'), help='server private host key file (default: <none>)')
     group.add_argument('--serverhostkeyalg', metavar='RSA ECDSA', default="RSA", type=str, help='server host key algorithm (default: <RSA>)')
+    group.add_argument('--statedir', metavar='directory', default=os.path.join('~', '.ncproxy'), help='generated proxy host key and rule cache (default: <~/.ncproxy>)')
+
+    group = parser.add_argument_group()
+    group.add_argument('--pool', action='store_true', help='reuse authenticated SSH transports to the server')
+    group.add_argument('--poolidle', metavar='seconds', type=int, default=60, help='close pooled transports unused for (default: <60>)')
+    group.add_argument('--poolmaxage', metavar='seconds', type=int, default=3600, help='maximum age of pooled transports (default: <3600>)')
+    group.add_argument('--poolchannels', metavar='channels', type=int, default=8, help='maximum sessions per pooled transport (default: <8>)')
+
+    group = parser.add_argument_group()
+    group.add_argument('--cache', metavar='operations', type=lambda value: [name for name in value.split(',') if name], default=[], help='cache replies of comma separated read-only operations, e.g. get-schema,get (default: <none>)')
+    group.add_argument('--cachesize', metavar='bytes', type=nc_size, default=64 * 1024 * 1024, help='maximum size of cached replies (default: <64M>)')
+    group.add_argument('--cachettl', metavar='seconds', type=int, default=60, help='time cached replies are used (default: <60>)')
+
+    group = parser.add_argument_group()
+    group.add_argument('--ratelimit', metavar='rpcs', type=float, default=0, help='rpcs per second forwarded to each server (default: <unlimited>)')
+    group.add_argument('--rateburst', metavar='rpcs', type=int, default=10, help='rpcs forwarded to a server at once within the rate limit (default: <10>)')
+    group.add_argument('--maxoutstanding', metavar='rpcs', type=int, default=0, help='rpcs per server forwarded and waiting for a reply (default: <unlimited>)')
+    group.add_argument('--priority', metavar='class:operations', type=nc_priority, nargs='+', default=[], help='priority class high, normal or low of comma separated operations, e.g. low:get,get-config (default: <%s>)' % ncScheduler.PRIORITY)
+
+    group = parser.add_argument_group()
+    group.add_argument('--fanout', action='store_true', help='share notification subscriptions of equal create-subscription rpcs')
+    group.add_argument('--fanoutqueue', metavar='bytes', type=nc_size, default=1024 * 1024, help='notifications queued per client session (default: <1M>)')
+    group.add_argument('--fanoutdrop', choices=ncFanout.DROP, default='oldest', help='notifications dropped or session disconnected if the queue is full (default: <oldest>)')
+
+    group = parser.add_argument_group()
+    group.add_argument('--handshakeworkers', metavar='threads', type=int, default=16, help='concurrent client handshakes (default: <16>)')
+    group.add_argument('--handshakequeue', metavar='connections', type=int, default=128, help='connections waiting for a handshake (default: <128>)')
+    group.add_argument('--handshaketimeout', metavar='seconds', type=int, default=30, help='time from accept to authenticated session (default: <30>)')
+    group.add_argument('--maxsessions', metavar='sessions', type=int, default=0, help='maximum client sessions (default: <unlimited>)')
+
+    group = parser.add_argument_group()
+    group.add_argument('--workers', metavar='processes', type=int, default=1, help='worker processes sharing the listening ports (default: <1>)')
+    group.add_argument('--draintimeout', metavar='seconds', type=int, default=300, help='time for sessions of replaced workers to finish (default: <300>)')
 
     group = parser.add_argument_group()
     group.add_argument('--port', metavar='tcpport', type=int, default=830, help='TCP-port ncproxy is listening')
-    group.add_argument('server', metavar='netconf://<hostname>[:port]', default="netconf://127.0.0.1:830", help='Netconf over SSH server')
+    group.add_argument('--relay', choices=['select', 'poll'], default='select', help='relay engine: event-driven or legacy 10ms polling (default: <select>)')
+    group.add_argument('--relayqueue', metavar='bytes', type=nc_size, default=4 * 1024 * 1024, help='data queued per direction before reading pauses (default: <4M>)')
+    group.add_argument('--clientwindow', metavar='bytes', type=nc_size, default=paramiko.common.DEFAULT_WINDOW_SIZE, help='SSH window size of client sessions (default: <2M>)')
+    group.add_argument('--clientpacket', metavar='bytes', type=nc_size, default=paramiko.common.DEFAULT_MAX_PACKET_SIZE, help='SSH maximum packet size of client sessions (default: <32K>)')
+    group.add_argument('--serverwindow', metavar='bytes', type=nc_size, default=paramiko.common.DEFAULT_WINDOW_SIZE, help='SSH window size of server sessions (default: <2M>)')
+    group.add_argument('--serverpacket', metavar='bytes', type=nc_size, default=paramiko.common.DEFAULT_MAX_PACKET_SIZE, help='SSH maximum packet size of server sessions (default: <32K>)')
+    group.add_argument('--routes', metavar='filename', help='routing table for multiple NETCONF servers (default: <none>)')
+    group.add_argument('--replay', metavar='filename', nargs='+', help='answer from recorded requests/responses (.jsonl or .ncap), no server (default: <none>)')
+    group.add_argument('server', metavar='netconf://<hostname>[:port]', nargs='?', help='Netconf over SSH server')
 
     options = parser.parse_args()
 
@@ -382,6 +3862,8 @@ if __name__ == '__main__':
         loghandler = logging.StreamHandler(options.logfile)
     timeformat = '%y/%m/%d %H:%M:%S'
     logformat = '%(asctime)s,%(msecs)-3d %(levelname)-8s %(message)s'
+    if options.workers > 1:
+        logformat = '%(asctime)s,%(msecs)-3d %(process)-6d %(levelname)-8s %(message)s'
     loghandler.setFormatter(logging.Formatter(logformat, timeformat))
 
     log = logging.getLogger('paramiko')
@@ -424,105 +3906,279 @@ if __name__ == '__main__':
         log.setLevel(logging.DEBUG)
         log.addHandler(loghandler)
 
-    # --- set server/client log ----------------------------------------------
-    serverlog = options.serverlog
-    clientlog = options.clientlog
+    # --- RPC latency and throughput metrics ---------------------------------
+    metrics = ncMetrics(options.metricsport is not None or options.metricsfile is not None)
+    try:
+        if options.metricsport is not None:
+            metrics.serve(options.metricsport)
+        if options.metricsfile is not None:
+            metrics.dump(options.metricsfile, options.metricsinterval)
+    except Exception as e:
+        log.critical('Metrics setup failed: %s', str(e))
+        sys.exit(1)
+
+    # --- server host key ----------------------------------------------------
+    server_host_key = None
+    if options.serverhostkey is not None:
+        server_host_key = nc_loadkey(options.serverhostkey.name, options.serverhostkeyalg)
+        log.debug('server host Key: %s', binascii.hexlify(server_host_key.get_fingerprint()))
 
     # --- parse server URL ---------------------------------------------------
-    if options.server.find('://') == -1:
-        url = urlparse("netconf://" + options.server)
-    else:
-        url = urlparse(options.server)
+    replay = None
+    default = None
+    if options.replay:
+        try:
+            replay = ncReplay.load(options.replay)
+        except Exception as e:
+            log.critical('Loading replay recording failed: %s', str(e))
+            log.debug(''.join(traceback.format_exception(*sys.exc_info())))
+            sys.exit(1)
+
+    elif options.server is None and options.routes is None:
+        parser.error('NETCONF server, --routes or --replay required')
 
-    if url.scheme != "netconf":
-        log.critical('Connection to NETCONF server(s) only')
+    elif options.server is not None:
+        try:
+            default = ncRoutes.target(options.server, server_host_key)
+            default['username'] = None
+        except ValueError:
+            log.critical('Connection to NETCONF server(s) only')
+            sys.exit(1)
+
+    try:
+        routes = ncRoutes(options.routes, default)
+    except Exception as e:
+        log.critical('Loading routes failed: %s', str(e))
+        log.debug(''.join(traceback.format_exception(*sys.exc_info())))
         sys.exit(1)
 
-    # --- parse server URL ---------------------------------------------------
-    if options.patch:
-        rules = json.load(options.patch)
-        for rule in rules['server-msg-modifier']:
-            if rule.has_key('patch-file'):
-                with open(rule['patch-file'], 'r') as file:
-                    rule['patch'] = file.read()
-            rule['regex'] = re.compile(rule['match'], re.DOTALL)
-
-        for rule in rules['client-msg-modifier']:
-            if rule.has_key('patch-file'):
-                with open(rule['patch-file'], 'r') as file:
-                    rule['patch'] = file.read()
-            rule['regex'] = re.compile(rule['match'], re.DOTALL)
-
-        for rule in rules['auto-respond']:
-            if rule.has_key('response-file'):
-                with open(rule['response-file'], 'r') as file:
-                    rule['response'] = file.read()
-            rule['regex'] = re.compile(rule['match'], re.DOTALL)
-    else:
-        rules = {}
-        rules['server-msg-modifier'] = []
-        rules['client-msg-modifier'] = []
-        rules['auto-respond'] = []
+    # --- directory for the generated host key and the rule cache ------------
+    statedir = None
+    if options.statedir:
+        statedir = os.path.expanduser(options.statedir)
 
-    # --- waiting for incoming client connections ----------------------------
+    # --- load patch rules ---------------------------------------------------
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.settimeout(None)
-        sock.bind(('', options.port))
-        sock.listen(100)
-        log.info('Listening for client connection ...')
+        rules = ncRules(options.patch, statedir)
     except Exception as e:
-        log.critical('Server setup failed: %s', str(e))
+        log.critical('Loading patch rules failed: %s', str(e))
         log.debug(''.join(traceback.format_exception(*sys.exc_info())))
         sys.exit(1)
 
+    def reload():
+        routes.reload()
+        rules.reload()
+
     # --- client private key -------------------------------------------------
     client_private_key = None
     if options.clientprivatekey is not None:
         client_private_key = paramiko.RSAKey.from_private_key_file(options.clientprivatekey.name)
         log.debug('client private key: %s', binascii.hexlify(client_private_key.get_fingerprint()))
 
-    # --- server host key
-    server_host_key = None
-    if options.serverhostkey is not None:
-        if options.serverhostkeyalg == "ECDSA":
-            server_host_key = paramiko.ECDSAKey.from_private_key_file(options.serverhostkey.name)
-        else:
-            server_host_key = paramiko.RSAKey.from_private_key_file(options.serverhostkey.name)
-        log.debug('server host Key: %s', binascii.hexlify(server_host_key.get_fingerprint()))
-
     # --- proxy host key
-    if options.proxyhostkey is None:
+    if options.proxyhostkey is None and statedir is not None:
+        try:
+            proxy_host_key = nc_hostkey(statedir, options.proxyhostkeyalg)
+        except Exception as e:
+            log.critical('Loading proxy host key from %s failed: %s', statedir, str(e))
+            sys.exit(1)
+    elif options.proxyhostkey is None:
         log.debug('Generating new host key')
         proxy_host_key = paramiko.RSAKey.generate(2048)
     else:
-        if options.proxyhostkeyalg == "ECDSA":
-            proxy_host_key = paramiko.ECDSAKey.from_private_key_file(options.proxyhostkey.name)
-        else:
-            proxy_host_key = paramiko.RSAKey.from_private_key_file(options.proxyhostkey.name)
+        proxy_host_key = nc_loadkey(options.proxyhostkey.name, options.proxyhostkeyalg)
     log.debug('proxy host Key: %s', binascii.hexlify(proxy_host_key.get_fingerprint()))
+    paramiko.Transport.load_server_moduli()
 
-    # --- handler for incoming client connections ----------------------------
-    while True:
-        try:
-            client, addr = sock.accept()
-            log.info("Incoming client connection from %s (srcport: %d)", addr[0], addr[1])
-        except (KeyboardInterrupt, SystemExit):
-            log.info('ncproxy terminated by user')
-            sys.exit(1)
-        except Exception as e:
-            log.critical('Server listen failure: %s', str(e))
-            log.debug(''.join(traceback.format_exception(*sys.exc_info())))
-            sys.exit(1)
+    # --- worker processes sharing the listening ports ------------------------
+    workers = None
+    if options.workers > 1:
+        ncHandler.sessionids = ncSharedCounter()
+        workers = ncWorkers(options.workers, metrics, reload)
+        slot, pipe = workers.run()
+        metrics = ncMetrics(metrics.enabled)
+        if metrics.enabled:
+            metrics.publish(pipe)
+        else:
+            os.close(pipe)
+
+    # --- set server/client log ----------------------------------------------
+    try:
+        capture = ncCapture(options.serverlog, options.clientlog, options.capturedir, options.capturesplit,
+                            options.rotatesize, options.rotatetime, options.compress,
+                            options.capturequeue, options.capturedrop, options.captureformat)
+    except Exception as e:
+        log.critical('Capture setup failed: %s', str(e))
+        sys.exit(1)
 
+    # --- pool of transports to the NETCONF server ---------------------------
+    pool = ncTransportPool(options.pool, options.poolidle, options.poolmaxage, options.poolchannels)
+
+    # --- cache of replies to read-only rpcs ---------------------------------
+    cache = ncResponseCache(options.cache, options.cachesize, options.cachettl)
+    if cache.enabled:
+        metrics.cache = cache
+
+    # --- scheduler of the rpcs forwarded to the servers ---------------------
+    scheduler = ncScheduler(options.ratelimit, options.rateburst, options.maxoutstanding, options.priority)
+    if scheduler.enabled:
+        metrics.scheduler = scheduler
+
+    # --- notification subscriptions shared by client sessions ---------------
+    fanout = ncFanout(options.fanout, options.fanoutqueue, options.fanoutdrop)
+    if fanout.enabled:
+        metrics.fanout = fanout
+
+    # --- handshakes of incoming client connections --------------------------
+    def handshake(client, port, deadline):
+        """
+        Runs the SSH handshake and waits for the client to authenticate.
+        """
+        t = paramiko.Transport(client, default_window_size=options.clientwindow,
+                               default_max_packet_size=options.clientpacket)
         try:
-            t = paramiko.Transport(client)
-            t.load_server_moduli()
+            t.banner_timeout = t.handshake_timeout = t.auth_timeout = max(1, deadline - time.time())
             t.add_server_key(proxy_host_key)
             t.set_subsystem_handler('netconf', ncHandler)
-            t.start_server(server=ssh_server())
-        except Exception as e:
-            log.warning('Connection failed: %s', str(e))
+            server = ssh_server(port)
+            t.start_server(server=server)
+            watcher = threading.Thread(target=server.closed, args=(t,), name='ssh_server')
+            watcher.daemon = True
+            watcher.start()
+            if not server.authenticated.wait(max(0, deadline - time.time())):
+                raise paramiko.SSHException('not authenticated within %d seconds' % options.handshaketimeout)
+        except Exception:
+            t.close()
+            raise
+        return t
+
+    admission = ncAdmission(handshake, options.handshakeworkers, options.handshakequeue,
+                            options.handshaketimeout, options.maxsessions)
+
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload())
+
+    def report(signum, frame):
+        rules.report()
+        pool.report()
+        cache.report()
+        scheduler.report()
+        fanout.report()
+        admission.report()
+        capture.report()
+        if replay is not None:
+            replay.report()
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, report)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    drain = []
+    if workers is not None:
+        # --- sessions of draining workers move to the new rules as well -----
+        def retire(signum, frame):
+            if not drain:
+                drain.append(time.time() + options.draintimeout)
+            rules.reload()
+
+        signal.signal(signal.SIGUSR2, retire)
+
+    # --- waiting for incoming client connections ----------------------------
+    listeners = {}
+    sel = selectors.DefaultSelector()
+
+    def listen(port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if workers is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.settimeout(None)
+        sock.bind(('', port))
+        sock.listen(100)
+        listeners[port] = sock
+        sel.register(sock, selectors.EVENT_READ, port)
+        log.info('Listening for client connection on port %d ...', port)
+
+    def update_listeners():
+        """
+        Follows the ports of the routing table after reloads.
+        """
+        ports = routes.ports() | set([options.port])
+        for port in ports - set(listeners):
+            try:
+                listen(port)
+            except Exception as e:
+                log.error('Listening on port %d failed: %s', port, str(e))
+        for port in set(listeners) - ports:
+            log.info('Closing port %d', port)
+            sel.unregister(listeners[port])
+            listeners.pop(port).close()
+
+    try:
+        listen(options.port)
+    except Exception as e:
+        log.critical('Server setup failed: %s', str(e))
+        log.debug(''.join(traceback.format_exception(*sys.exc_info())))
+        sys.exit(1)
+    update_listeners()
+
+    # --- handler for incoming client connections ----------------------------
+    status = 1
+    try:
+        while True:
+            try:
+                events = sel.select(timeout=routes.interval if workers is None else 1)
+                if workers is not None and not drain and os.getppid() != workers.master:
+                    log.error('Master process gone')
+                    drain.append(time.time() + options.draintimeout)
+                if drain:
+                    rules.check()
+                    # --- stop accepting, exit once all sessions are closed --
+                    for port in list(listeners):
+                        sock = listeners.pop(port)
+                        sel.unregister(sock)
+                        sock.setblocking(False)
+                        try:
+                            while True:
+                                client, addr = sock.accept()
+                                client.setblocking(True)
+                                admission.submit(client, addr, port)
+                        except socket.error:
+                            pass
+                        sock.close()
+                    with admission.lock:
+                        sessions = admission.sessions()
+                    if sessions == 0 or time.time() > drain[0]:
+                        log.info('Worker drained (%d sessions left)', sessions)
+                        sys.exit(0)
+                    continue
+                routes.check()
+                rules.check()
+                update_listeners()
+            except Exception as e:
+                log.critical('Server listen failure: %s', str(e))
+                log.debug(''.join(traceback.format_exception(*sys.exc_info())))
+                sys.exit(1)
+
+            for key, mask in events:
+                try:
+                    client, addr = key.fileobj.accept()
+                    log.info("Incoming client connection from %s (srcport: %d, port: %d)", addr[0], addr[1], key.data)
+                except Exception as e:
+                    log.warning('Accepting client connection failed: %s', str(e))
+                    continue
+
+                admission.submit(client, addr, key.data)
+
+    except KeyboardInterrupt:
+        log.info('ncproxy terminated by user')
+    except SystemExit as e:
+        # --- SIGTERM and drained workers exit with 0 ------------------------
+        status = e.code
+
+    report(None, None)
+    capture.stop()
+    metrics.send()
+    sys.exit(status)
 
 # EOF
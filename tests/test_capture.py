@@ -0,0 +1,78 @@
+"""
+Unit tests of the indexed capture reader (ncCaptureReader, nc_reindex)
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ncproxy import NCAP_MAGIC, NCAP_RECORD, NCIX_ENTRY, NCIX_MAGIC, ncCaptureReader, nc_reindex
+
+
+class TestCaptureReader(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'capture.ncap')
+        self.indexname = os.path.join(self.directory, 'capture.ncidx')
+        data, index = [NCAP_MAGIC], [NCIX_MAGIC]
+        offset = len(NCAP_MAGIC)
+        for idx in range(3):
+            msgid = str(idx).encode('utf-8')
+            msg = b'<rpc message-id="%s"><get/></rpc>]]>]]>' % msgid
+            data.append(NCAP_RECORD.pack(len(msg), 1, 100.0 + idx, 0, 2, len(msgid), 3) + msgid + b'get' + msg)
+            index.append(NCIX_ENTRY.pack(offset, 100.0 + idx, 1, zlib.crc32(msgid), 0, 2))
+            offset += len(data[-1])
+        with open(self.filename, 'wb') as file:
+            file.write(b''.join(data))
+        self.index = b''.join(index)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self):
+        reader = ncCaptureReader(self.filename)
+        try:
+            return [record.msgid for record in reader.select()]
+        finally:
+            reader.close()
+
+    def test_reindex(self):
+        self.assertEqual(nc_reindex(self.filename), 3)
+        with open(self.indexname, 'rb') as file:
+            self.assertEqual(file.read(), self.index)
+        self.assertFalse(os.path.exists(self.indexname + '.tmp'))
+
+    def test_missing_index(self):
+        self.assertEqual(self.read(), ['0', '1', '2'])
+
+    def test_corrupt_index(self):
+        with open(self.indexname, 'wb') as file:
+            file.write(b'garbage\n')
+        self.assertEqual(self.read(), ['0', '1', '2'])
+        with open(self.indexname, 'rb') as file:
+            self.assertEqual(file.read(), self.index)
+
+    def test_short_index(self):
+        with open(self.indexname, 'wb') as file:
+            file.write(self.index[:-NCIX_ENTRY.size])
+        self.assertEqual(self.read(), ['0', '1', '2'])
+
+    def test_partial_record_kept(self):
+        # --- a record still being written does not invalidate the index -----
+        with open(self.indexname, 'wb') as file:
+            file.write(self.index)
+        with open(self.filename, 'ab') as file:
+            file.write(NCAP_RECORD.pack(100, 1, 200.0, 0, 2, 0, 0))
+        os.utime(self.indexname, (0, 0))
+        self.assertEqual(self.read(), ['0', '1', '2'])
+        self.assertEqual(os.stat(self.indexname).st_mtime, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
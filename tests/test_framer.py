@@ -0,0 +1,199 @@
+"""
+Unit tests of the NETCONF framing codec (ncFramer)
+"""
+
+import mmap
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ncproxy import ncFramer, ncFramingError
+
+HELLO = (b'<?xml version="1.0" encoding="UTF-8"?>'
+         b'<hello xmlns="urn:ietf:params:xml:ns:netconf:base:1.0"><capabilities>'
+         b'<capability>urn:ietf:params:netconf:base:1.1</capability>'
+         b'</capabilities></hello>')
+RPC = b'<rpc message-id="%d" xmlns="urn:ietf:params:xml:ns:netconf:base:1.0"><get/></rpc>'
+
+
+def chunked(msg, sizes=None):
+    """
+    Returns msg in chunked framing, split into chunks of sizes.
+    """
+    sizes = sizes or [len(msg)]
+    out = []
+    pos = 0
+    for size in sizes:
+        out.append(b'\n#%d\n' % size + msg[pos:pos + size])
+        pos += size
+    return b''.join(out) + b'\n##\n'
+
+
+class TestFramer(unittest.TestCase):
+
+    def feed(self, framer, data, step=None):
+        """
+        Feeds data in pieces of step bytes and returns the messages popped.
+        """
+        msgs = []
+        step = step or len(data) or 1
+        for pos in range(0, len(data), step):
+            framer.feed(data[pos:pos + step])
+            msgs.extend(bytes(msg) for msg in framer)
+        return msgs
+
+    def test_eom(self):
+        framer = ncFramer()
+        data = RPC % 1 + b']]>]]>' + RPC % 2 + b']]>]]>'
+        self.assertEqual(self.feed(framer, data), [RPC % 1, RPC % 2])
+        self.assertTrue(framer.base10)
+        self.assertTrue(framer.idle())
+
+    def test_eom_partial(self):
+        framer = ncFramer()
+        self.assertEqual(self.feed(framer, RPC % 1 + b']]>]]'), [])
+        self.assertFalse(framer.idle())
+        self.assertEqual(self.feed(framer, b'>'), [RPC % 1])
+
+    def test_chunked(self):
+        framer = ncFramer()
+        msg = RPC % 1
+        data = chunked(msg, [10, 20, len(msg) - 30]) + chunked(RPC % 2)
+        self.assertEqual(self.feed(framer, data), [msg, RPC % 2])
+        self.assertFalse(framer.base10)
+
+    def test_hello_switches_to_chunked(self):
+        framer = ncFramer()
+        data = HELLO + b']]>]]>' + chunked(RPC % 1) + chunked(RPC % 2, [5, len(RPC % 2) - 5])
+        msgs = []
+        framer.feed(data)
+        msg = framer.pop()
+        self.assertEqual(msg, HELLO)
+        self.assertTrue(framer.base10)
+        for msg in framer:
+            msgs.append(msg)
+            self.assertFalse(framer.base10)
+        self.assertEqual(msgs, [RPC % 1, RPC % 2])
+
+    def test_split_across_reads(self):
+        # --- every delimiter and chunk header is split at every position ----
+        data = HELLO + b']]>]]>' + chunked(RPC % 1, [7, 1, len(RPC % 1) - 8]) + chunked(RPC % 2)
+        expected = [HELLO, RPC % 1, RPC % 2]
+        for step in (1, 2, 3, 5, 7, 13):
+            self.assertEqual(self.feed(ncFramer(), data, step), expected, 'step %d' % step)
+        for cut in range(1, len(data)):
+            framer = ncFramer()
+            self.assertEqual(self.feed(framer, data[:cut]) + self.feed(framer, data[cut:]), expected, 'cut %d' % cut)
+
+    def test_framed_as_received(self):
+        framer = ncFramer()
+        for data in (RPC % 1 + b']]>]]>', chunked(RPC % 2, [3, 4, len(RPC % 2) - 7])):
+            framer.feed(data)
+            framer.pop()
+            # --- a view of the bytes as received, not a rebuilt copy --------
+            self.assertIsInstance(framer.framed(), memoryview)
+            self.assertEqual(bytes(framer.framed()), data)
+
+    def test_frame(self):
+        framer = ncFramer()
+        self.assertEqual(framer.frame(b'<a/>', base10=True), b'<a/>]]>]]>')
+        self.assertEqual(framer.frame(b'<a/>', base10=False), b'\n#4\n<a/>\n##\n')
+        framer.feed(chunked(RPC % 1))
+        framer.pop()
+        self.assertEqual(framer.frame(b'<a/>'), b'\n#4\n<a/>\n##\n')
+
+    def test_invalid_chunk_headers(self):
+        for data in (b'\n#abc\n<a/>\n##\n',
+                     b'\n#0\n\n##\n',
+                     b'\n#012\n<a/>\n##\n',
+                     b'\n#99999999999\n',
+                     b'\n#4294967296\n',
+                     b'\n#4\n<a/>XXXX'):
+            framer = ncFramer()
+            framer.feed(data)
+            with self.assertRaises(ncFramingError, msg=repr(data)):
+                framer.pop()
+            # --- the framer is reset and usable again -----------------------
+            self.assertTrue(framer.idle())
+            framer.feed(RPC % 1 + b']]>]]>')
+            self.assertEqual(framer.pop(), RPC % 1)
+
+    def test_spool_eom(self):
+        msg = b'<rpc-reply message-id="1"><data>' + b'x' * 100000 + b'</data></rpc-reply>'
+        framer = ncFramer(maxbuffer=4096)
+        msgs = self.feed(framer, msg + b']]>]]>' + RPC % 2 + b']]>]]>', 8192)
+        self.assertEqual(msgs, [msg, RPC % 2])
+
+        framer = ncFramer(maxbuffer=4096)
+        framer.feed(msg + b']]>]]>')
+        spooled = framer.pop()
+        self.assertIsInstance(spooled, mmap.mmap)
+        self.assertEqual(spooled[:], msg)
+        self.assertEqual(bytes(framer.framed()), msg + b']]>]]>')
+
+    def test_spool_chunked(self):
+        msg = b'<rpc-reply message-id="1"><data>' + b'y' * 100000 + b'</data></rpc-reply>'
+        framer = ncFramer(maxbuffer=4096)
+        framer.feed(chunked(msg, [50000, len(msg) - 50000]))
+        spooled = framer.pop()
+        self.assertIsInstance(spooled, mmap.mmap)
+        self.assertEqual(spooled[:], msg)
+        # --- spooled messages are forwarded as a single chunk ---------------
+        self.assertEqual(bytes(framer.framed()), chunked(msg))
+
+    def test_below_maxbuffer_not_spooled(self):
+        framer = ncFramer(maxbuffer=4096)
+        framer.feed(RPC % 1 + b']]>]]>')
+        self.assertIsInstance(framer.pop(), bytes)
+
+    def test_headsize(self):
+        msg = b'<rpc-reply message-id="1"><data>' + b'z' * 100000 + b'</data></rpc-reply>'
+        for data in (msg + b']]>]]>' + RPC % 2 + b']]>]]>',
+                     chunked(msg, [10, 50000, len(msg) - 50010]) + chunked(RPC % 2)):
+            framer = ncFramer(maxbuffer=4096, headsize=64)
+            msgs = self.feed(framer, data, 1000)
+            self.assertEqual(msgs, [msg[:64], (RPC % 2)[:64]])
+            self.assertIsNone(framer.spool)
+            self.assertTrue(framer.idle())
+
+    def test_stream(self):
+        msg = b'<rpc-reply message-id="1"><data>' + b's' * 100000 + b'</data></rpc-reply>'
+        for data in (msg + b']]>]]>', chunked(msg, [10, 50000, len(msg) - 50010])):
+            heads = []
+            framer = ncFramer(stream=lambda head: heads.append(head) or True, peeksize=64)
+            out, msgs = bytearray(), []
+            for pos in range(0, len(data), 1000):
+                framer.feed(data[pos:pos + 1000])
+                for head in framer:
+                    msgs.append(head)
+                    self.assertIsNone(framer.framed())
+                    out += framer.flush()
+                out += framer.flush()
+                # --- streamed bytes are handed out before the message ends --
+                if pos + 1000 < len(data):
+                    self.assertEqual(len(out), pos + 1000 - len(framer.buf))
+            self.assertEqual(bytes(out), data)
+            self.assertEqual(heads, [msg[:64]])
+            self.assertEqual(msgs, [msg[:64]])
+            self.assertTrue(framer.idle())
+
+    def test_stream_declined(self):
+        msg = b'<rpc-reply message-id="1"><data>' + b'd' * 10000 + b'</data></rpc-reply>'
+        heads = []
+        framer = ncFramer(stream=lambda head: heads.append(head), peeksize=64)
+        data = chunked(msg, [10, 5000, len(msg) - 5010]) + chunked(RPC % 2)
+        self.assertEqual(self.feed(framer, data, 7), [msg, RPC % 2])
+        self.assertEqual(heads, [msg[:64], (RPC % 2)[:64]])
+        self.assertEqual(framer.flush(), b'')
+
+    def test_headsize_switch(self):
+        framer = ncFramer(headsize=16)
+        self.assertEqual(self.feed(framer, RPC % 1 + b']]>]]>', 7), [(RPC % 1)[:16]])
+        framer.headsize = None
+        self.assertEqual(self.feed(framer, RPC % 2 + b']]>]]>', 7), [RPC % 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+"""
+Unit tests of the rpc scheduler (ncScheduler)
+"""
+
+import logging
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ncproxy
+from ncproxy import ncMetrics, ncScheduler
+
+DEVICE = ('127.0.0.1', 830)
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        ncproxy.log = logging.getLogger('ncproxy')
+        ncproxy.metrics = ncMetrics()
+        self.woken = []
+
+    def job(self, operation='get'):
+        job = {'operation': operation, 'done': False}
+        job['wake'] = lambda: self.woken.append(job)
+        return job
+
+    def test_first_rpc_within_burst(self):
+        scheduler = ncScheduler(rate=1, burst=1)
+        self.assertTrue(scheduler.submit(DEVICE, self.job()))
+        self.assertFalse(scheduler.submit(DEVICE, self.job()))
+
+    def test_maxoutstanding(self):
+        scheduler = ncScheduler(maxoutstanding=2)
+        self.assertTrue(scheduler.submit(DEVICE, self.job()))
+        self.assertTrue(scheduler.submit(DEVICE, self.job()))
+        low, high = self.job('get'), self.job('commit')
+        self.assertFalse(scheduler.submit(DEVICE, low))
+        self.assertFalse(scheduler.submit(DEVICE, high))
+        # --- a released slot goes to the highest class first ----------------
+        scheduler.release(DEVICE)
+        self.assertEqual(self.woken, [high])
+        self.assertTrue(high['done'])
+        scheduler.release(DEVICE)
+        self.assertEqual(self.woken, [high, low])
+
+
+if __name__ == '__main__':
+    unittest.main()